@@ -0,0 +1,71 @@
+# mipmap levels of the atlas, tiles are surrounded by a copy of their edges
+# large enough to still be one texel wide on the last level so that linear
+# filtering never mixes neighbouring tiles
+ATLAS_LEVELS = 4
+GUTTER = 2 ** (ATLAS_LEVELS - 1)
+
+
+def tile_size(ratio, tile_pixels):
+    """Size of the tiles images in the atlas, a multiple of each mipmap level
+    size ratio
+    """
+    height = max(GUTTER, -(-tile_pixels // GUTTER) * GUTTER)
+    width = max(GUTTER, int(round(height * ratio / GUTTER)) * GUTTER)
+    return width, height
+
+
+class Atlas(object):
+    """Packs same sized tiles in a grid of slots spread over square pages.
+    Coordinates are in pixels from the bottom left corner of a page, as OpenGL
+    expects them. Slots of removed tiles are reused.
+    """
+
+    def __init__(self, tile_width, tile_height, page_size=4096, pages=1):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.page_size = page_size
+        self.pages = pages
+        self.columns = page_size // tile_width
+        self.rows = page_size // tile_height
+        if self.columns == 0 or self.rows == 0:
+            raise ValueError(
+                "{}x{} tiles don't fit in {}x{} pages".format(
+                    tile_width, tile_height, page_size, page_size
+                )
+            )
+        self.slots = {}
+        self.free = []
+
+    def __contains__(self, picture):
+        return picture in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def page_capacity(self):
+        return self.columns * self.rows
+
+    @property
+    def capacity(self):
+        return self.pages * self.page_capacity
+
+    def full(self):
+        return len(self.slots) >= self.capacity
+
+    def position(self, slot):
+        page, slot = divmod(slot, self.page_capacity)
+        row, column = divmod(slot, self.columns)
+        return page, column * self.tile_width, row * self.tile_height
+
+    def add(self, picture):
+        """Reserves a slot for picture, returns its (page, x, y)."""
+        if picture not in self.slots:
+            if self.full():
+                raise ValueError("atlas is full")
+            # without free slots, slots 0 to len(self.slots) - 1 are all used
+            self.slots[picture] = self.free.pop() if self.free else len(self.slots)
+        return self.position(self.slots[picture])
+
+    def remove(self, picture):
+        self.free.append(self.slots.pop(picture))
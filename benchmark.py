@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from os import cpu_count, makedirs, path
+
+import numpy as np
+from PIL import Image
+
+import cache
+from features import METRICS
+
+# width, height and share of the generated photos ratios
+RATIOS = ((4, 3, 0.6), (3, 2, 0.3), (16, 9, 0.1))
+# EXIF orientations of the generated photos, upright ones are the most common
+ORIENTATIONS = (1, 1, 1, 1, 3, 6, 8)
+PHOTO_HEIGHT = 96
+
+parser = argparse.ArgumentParser(
+    description="Times each stage of the mosaics pipeline on synthetic photos"
+)
+parser.add_argument(
+    "sizes",
+    type=int,
+    nargs="*",
+    default=[100, 1000],
+    help="number of photos of each library (defaults to 100 1000)",
+)
+parser.add_argument(
+    "-t", "--tiles", type=int, default=40, help="number of tiles in each mosaic"
+)
+parser.add_argument(
+    "-s", "--seed", type=int, default=0, help="seed of the generated photos"
+)
+parser.add_argument(
+    "-w",
+    "--walk-steps",
+    type=int,
+    default=10000,
+    help="number of steps of the timed walk (defaults to 10000)",
+)
+parser.add_argument(
+    "-i",
+    "--index",
+    choices=["cube", "linear"],
+    default="cube",
+    help="color index used to find the nearest tiles (defaults to cube)",
+)
+parser.add_argument(
+    "-m",
+    "--metric",
+    choices=list(METRICS),
+    default="rgb",
+    help="how cells and tiles are compared (defaults to rgb)",
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="number of processes analyzing photos (defaults to the number of CPUs)",
+)
+parser.add_argument(
+    "-l",
+    "--libraries",
+    type=str,
+    default=path.join(cache.CACHE_DIR, "benchmark"),
+    help="folder where the generated libraries are kept between runs",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default="benchmark.json",
+    help="report written as JSON (defaults to benchmark.json)",
+)
+parser.add_argument(
+    "-c",
+    "--compare",
+    type=str,
+    default=None,
+    metavar="REPORT",
+    help="previous report to compare the stage durations with",
+)
+
+
+def generate_photo(fpath, seed):
+    rng = np.random.default_rng(seed)
+    width, height, _ = RATIOS[rng.choice(len(RATIOS), p=[r[2] for r in RATIOS])]
+    size = (int(round(PHOTO_HEIGHT * width / height)), PHOTO_HEIGHT)
+    # smooth variations around a dominant color
+    color = rng.integers(0, 256, 3)
+    cells = np.clip(color + rng.integers(-64, 65, (3, 4, 3)), 0, 255)
+    image = Image.fromarray(cells.astype(np.uint8)).resize(
+        size, Image.Resampling.BILINEAR
+    )
+    exif = Image.Exif()
+    exif[274] = int(rng.choice(ORIENTATIONS))
+    image.save(fpath, "JPEG", quality=90, exif=exif)
+
+
+def generate_library(folder, count, seed):
+    """count photos depending only on seed, existing ones are kept"""
+    makedirs(folder, exist_ok=True)
+    for i in range(count):
+        fpath = path.join(folder, "{:06d}.jpg".format(i))
+        if not path.exists(fpath):
+            generate_photo(fpath, (seed, count, i))
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=path.dirname(path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_library(folder, cache_dir):
+    """Durations in seconds of each stage on a library and an empty cache"""
+    from graph import (
+        Walk,
+        biggest_strongly_connected_component,
+        load_from_cache,
+        transition_graph,
+    )
+    from mosaicfactory import MosaicFactory
+    from store import Store
+    from tour import plan_tour
+
+    stages = {}
+
+    @contextmanager
+    def stage(name):
+        print("{}:".format(name))
+        start = time.perf_counter()
+        yield
+        stages[name] = time.perf_counter() - start
+        print(" {:.3f}s".format(stages[name]))
+
+    database = path.join(cache_dir, path.basename(folder) + ".sqlite")
+    factory = MosaicFactory(args.index, store=Store(database), metric=args.metric)
+    with stage("ingest"):
+        factory.load(folder, args.jobs)
+    with stage("grids"):
+        for img in factory.images.values():
+            factory.cells_features(img, args.tiles)
+    with stage("matching"):
+        factory.all_mosaics(args.tiles)
+    # at most tiles² photos are needed, smaller libraries get fewer tiles
+    no_reuse_tiles = min(args.tiles, int(np.sqrt(len(factory.images))))
+    with stage("matching without reuse"):
+        factory.all_mosaics(no_reuse_tiles, False)
+    with stage("graph"):
+        gr = transition_graph(factory, args.tiles)
+    with stage("strongly connected component"):
+        component = biggest_strongly_connected_component(gr)
+    with stage("walk"):
+        Walk(component).path(0, args.walk_steps)
+    with stage("tour"):
+        plan_tour(component)
+    with stage("cache load"):
+        factory = MosaicFactory(args.index, store=Store(database), metric=args.metric)
+        factory.load(folder, args.jobs)
+        load_from_cache(factory, args.tiles)
+    return {
+        "photos": len(factory.images),
+        "no_reuse_tiles": no_reuse_tiles,
+        "stages": stages,
+    }
+
+
+def compare(report, previous):
+    for size, library in report["libraries"].items():
+        if size not in previous["libraries"]:
+            continue
+        print("{} photos:".format(size))
+        old = previous["libraries"][size]["stages"]
+        for name, duration in library["stages"].items():
+            if name in old:
+                print(
+                    " {}: {:.3f}s -> {:.3f}s ({:+.0%})".format(
+                        name, old[name], duration, duration / old[name] - 1
+                    )
+                )
+
+
+def main():
+    global args
+
+    args = parser.parse_args()
+    report = {
+        "revision": revision(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": cpu_count(),
+        "tiles": args.tiles,
+        "seed": args.seed,
+        "walk_steps": args.walk_steps,
+        "index": args.index,
+        "metric": args.metric,
+        "libraries": {},
+    }
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # thumbnails, grids and color indexes start from an empty cache too,
+        # this has to happen before the modules using CACHE_DIR are imported
+        cache.CACHE_DIR = cache_dir
+        for size in args.sizes:
+            folder = path.join(args.libraries, "{}-{}".format(size, args.seed))
+            print("generating {} photos in {}".format(size, folder))
+            generate_library(folder, size, args.seed)
+            report["libraries"][str(size)] = benchmark_library(folder, cache_dir)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("report written to {}".format(args.output))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import copy
+from os import makedirs, path
+
+import numpy as np
+
+from memoized import memoized
+
+# maximum number of elements of the temporary distances arrays
+CHUNK_SIZE = 2**22
+# larger than any distance between two colors or descriptors
+INFINITY = np.iinfo(np.int32).max
+
+
+def to_color_array(colors):
+    return np.asarray(colors, dtype=np.int32).reshape(-1, 3)
+
+
+def to_feature_array(features):
+    features = np.asarray(features, dtype=np.float32)
+    return features.reshape(-1, features.shape[-1] if features.ndim > 1 else 1)
+
+
+def l1_distances(colors, palette):
+    return np.abs(colors[:, np.newaxis, :] - palette[np.newaxis, :, :]).sum(axis=2)
+
+
+def concatenated_ranges(starts, lengths):
+    """Vectorized np.concatenate([np.arange(s, s + l) for s, l in ...])"""
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+@memoized
+def cube_shell(radius):
+    """Offsets of the cubes at Chebyshev distance radius from a cube"""
+    axis = np.arange(-radius, radius + 1)
+    offsets = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1)
+    offsets = offsets.reshape(-1, 3)
+    return offsets[np.abs(offsets).max(axis=1) == radius]
+
+
+class ColorIndex(object):
+    """Exact L1 nearest neighbour search in a contiguous N×3 array of colors.
+    Ties are resolved in favor of the lowest index, like a linear scan would.
+    Removed colors are never returned.
+    """
+
+    name = None
+    to_array = staticmethod(to_color_array)
+
+    def __init__(self, colors):
+        self.colors = self.to_array(colors)
+        self.alive = np.ones(len(self.colors), dtype=bool)
+        self.size = len(self.colors)
+
+    def __len__(self):
+        return self.size
+
+    def copy(self):
+        res = copy.copy(self)
+        res.alive = self.alive.copy()
+        return res
+
+    def remove(self, i):
+        if self.alive[i]:
+            self.alive[i] = False
+            self.size -= 1
+
+    def nearest(self, colors):
+        raise NotImplementedError
+
+    def distances(self, colors, palette):
+        """len(colors)×len(palette) distances, only their order in each line
+        matters
+        """
+        return l1_distances(colors, palette)
+
+    def pair_distances(self, colors, others):
+        return np.abs(colors - others).sum(axis=1)
+
+    def chunk_size(self, count):
+        # number of queries whose distances to count colors fit in CHUNK_SIZE
+        return max(1, CHUNK_SIZE // max(1, self.colors.shape[1] * count))
+
+    def nearest_k(self, colors, k):
+        """Indices of the k nearest colors, in no particular order."""
+        colors = self.to_array(colors)
+        alive = np.flatnonzero(self.alive)
+        k = min(k, len(alive))
+        res = np.empty((len(colors), k), dtype=np.intp)
+        palette = self.colors[alive]
+        step = self.chunk_size(len(alive))
+        for start in range(0, len(colors), step):
+            end = start + step
+            distances = self.distances(colors[start:end], palette)
+            res[start:end] = alive[np.argpartition(distances, k - 1, axis=1)[:, :k]]
+        return res
+
+    def subset(self, indices):
+        """Brute force index of the colors at indices"""
+        return LinearIndex(self.colors[indices])
+
+    def check_without_reuse(self, colors):
+        if len(colors) > len(self):
+            raise ValueError(
+                "{} colors can't be matched without reuse against {} colors".format(
+                    len(colors), len(self)
+                )
+            )
+
+    def nearest_without_reuse(self, colors):
+        """Greedy assignment: each color takes the nearest one still available."""
+        colors = self.to_array(colors)
+        self.check_without_reuse(colors)
+        index = self.copy()
+        res = np.empty(len(colors), dtype=np.intp)
+        for i in range(len(colors)):
+            res[i] = index.nearest(colors[np.newaxis, i])[0]
+            index.remove(res[i])
+        return res
+
+    def optimal_without_reuse(self, colors, k=8):
+        """Assignment minimizing the total distance, each color being matched to
+        one of its k nearest colors or to its greedy match.
+        """
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+        colors = self.to_array(colors)
+        self.check_without_reuse(colors)
+        # the greedy matches make sure a full matching exists
+        candidates = np.column_stack(
+            [self.nearest_without_reuse(colors), self.nearest_k(colors, k)]
+        )
+        columns, inverse = np.unique(candidates, return_inverse=True)
+        rows = np.repeat(np.arange(len(colors)), candidates.shape[1])
+        edges = np.unique(rows * len(columns) + inverse.ravel())
+        rows, inverse = np.divmod(edges, len(columns))
+        # zero weights would be read as missing edges
+        weights = self.pair_distances(colors[rows], self.colors[columns[inverse]]) + 1
+        graph = csr_matrix(
+            (weights, (rows, inverse)), shape=(len(colors), len(columns))
+        )
+        matched_rows, matched_columns = min_weight_full_bipartite_matching(graph)
+        res = np.empty(len(colors), dtype=np.intp)
+        res[matched_rows] = columns[matched_columns]
+        return res
+
+    def arrays(self):
+        return {"colors": self.colors}
+
+    def save(self, fpath):
+        makedirs(path.dirname(fpath), exist_ok=True)
+        with open(fpath, "wb") as f:
+            np.savez(f, **self.arrays())
+
+    @classmethod
+    def load(cls, fpath):
+        res = cls.__new__(cls)
+        with np.load(fpath) as data:
+            for key in data.files:
+                setattr(res, key, data[key])
+        res.alive = np.ones(len(res.colors), dtype=bool)
+        res.size = len(res.colors)
+        return res
+
+    @classmethod
+    def cached(cls, colors, fpath):
+        colors = cls.to_array(colors)
+        try:
+            index = cls.load(fpath)
+            if np.array_equal(index.colors, colors):
+                return index
+        except (IOError, ValueError, KeyError):
+            pass
+        index = cls(colors)
+        index.save(fpath)
+        return index
+
+
+class LinearIndex(ColorIndex):
+    """Brute force search, vectorized over chunks of queried colors."""
+
+    name = "linear"
+
+    def nearest(self, colors):
+        colors = self.to_array(colors)
+        res = np.empty(len(colors), dtype=np.intp)
+        step = self.chunk_size(len(self.colors))
+        for start in range(0, len(colors), step):
+            end = start + step
+            distances = self.distances(colors[start:end], self.colors)
+            distances[:, ~self.alive] = INFINITY
+            res[start:end] = distances.argmin(axis=1)
+        return res
+
+
+class FeatureIndex(LinearIndex):
+    """Brute force squared euclidean search in an N×D float array of descriptors,
+    such as the CIELAB colors of sub-grids of the images. The distances of chunks
+    of queries are computed with a single matrix product.
+    """
+
+    name = "features"
+    to_array = staticmethod(to_feature_array)
+
+    def distances(self, colors, palette):
+        # |c - p|² = |c|² - 2c·p + |p|², |c|² doesn't change the order of a line
+        return (palette**2).sum(axis=1) - 2 * colors @ palette.T
+
+    def pair_distances(self, colors, others):
+        return ((colors - others) ** 2).sum(axis=1)
+
+    def chunk_size(self, count):
+        return max(1, CHUNK_SIZE // max(1, count))
+
+    def subset(self, indices):
+        return FeatureIndex(self.colors[indices])
+
+
+class ColorCubeIndex(ColorIndex):
+    """Colors are bucketed in a grid of cubes of cell_size³ RGB values.
+    Each query searches the shells of cubes around its own one, the nearest
+    first, and stops once its best match is closer than any color outside of the
+    searched cubes: lookups only visit the buckets around the query.
+    """
+
+    name = "cube"
+
+    def __init__(self, colors, cell_size=None):
+        super().__init__(colors)
+        if cell_size is None:
+            # about 8 colors per bucket, with power of two sized buckets
+            side = max(1.0, (len(self.colors) / 8) ** (1 / 3))
+            cell_size = 2 ** int(np.clip(np.round(np.log2(256 / side)), 3, 8))
+        self.cell_size = np.int32(cell_size)
+        keys = self.cell_keys(self.colors)
+        # indices of colors sorted by bucket, only non empty buckets are kept:
+        # bucket b holds the colors order[starts[b]:starts[b + 1]]
+        self.order = np.argsort(keys, kind="stable").astype(np.intp)
+        self.keys, self.starts = np.unique(keys[self.order], return_index=True)
+        self.starts = np.append(self.starts, len(self.order))
+
+    def side(self):
+        # number of cubes along each axis
+        return 255 // int(self.cell_size) + 1
+
+    def cell_keys(self, colors):
+        return np.ravel_multi_index((colors // self.cell_size).T, (self.side(),) * 3)
+
+    def cube_starts(self):
+        # cube k holds the colors order[cube_starts[k]:cube_starts[k + 1]]
+        if getattr(self, "dense_starts", None) is None:
+            cubes = np.arange(self.side() ** 3 + 1)
+            positions = np.searchsorted(self.keys, cubes)
+            self.dense_starts = self.starts[positions]
+        return self.dense_starts
+
+    def cube_counts(self):
+        # number of alive colors in each cube
+        if getattr(self, "counts", None) is None:
+            self.counts = np.diff(self.cube_starts())
+        return self.counts
+
+    def copy(self):
+        res = super().copy()
+        res.counts = self.cube_counts().copy()
+        return res
+
+    def remove(self, i):
+        if self.alive[i]:
+            self.cube_counts()[self.cell_keys(self.colors[np.newaxis, i])[0]] -= 1
+        super().remove(i)
+
+    def arrays(self):
+        return {
+            "colors": self.colors,
+            "cell_size": self.cell_size,
+            "order": self.order,
+            "keys": self.keys,
+            "starts": self.starts,
+        }
+
+    def nearest(self, colors):
+        colors = to_color_array(colors)
+        res = np.full(len(colors), -1, dtype=np.intp)
+        best = np.full(len(colors), INFINITY, dtype=np.int32)
+        cells = colors // self.cell_size
+        active = np.arange(len(colors))
+        for radius in range(self.side()):
+            offsets = cube_shell(radius)
+            step = max(1, CHUNK_SIZE // (3 * len(offsets)))
+            for start in range(0, len(active), step):
+                end = start + step
+                self.search_cubes(colors, cells, active[start:end], offsets, res, best)
+            # colors outside of the searched cubes are at least that far
+            low = (cells[active] - radius) * self.cell_size
+            high = (cells[active] + radius + 1) * self.cell_size - 1
+            below = np.where(low > 0, colors[active] - low + 1, INFINITY)
+            above = np.where(high < 255, high - colors[active] + 1, INFINITY)
+            outside = np.minimum(below, above).min(axis=1)
+            # equally distant colors outside may have a lower index
+            active = active[best[active] >= outside]
+            if len(active) == 0:
+                break
+        return res
+
+    def cube_members(self, queries, cubes):
+        starts = self.cube_starts()
+        lengths = starts[cubes + 1] - starts[cubes]
+        owners = np.repeat(queries, lengths)
+        members = self.order[concatenated_ranges(starts[cubes], lengths)]
+        alive = self.alive[members]
+        return owners[alive], members[alive]
+
+    def search_cubes(self, colors, cells, queries, offsets, res, best):
+        """Updates the nearest colors res and their distances best of queries with
+        the colors of the cubes at offsets from their cubes
+        """
+        neighbors = cells[queries][:, np.newaxis, :] + offsets[np.newaxis, :, :]
+        inside = ((neighbors >= 0) & (neighbors < self.side())).all(axis=2)
+        query, offset = np.nonzero(inside)
+        neighbors = neighbors[query, offset]
+        query = queries[query]
+        cubes = np.ravel_multi_index(neighbors.T, (self.side(),) * 3)
+        # cubes farther than the best match so far can't hold a better one
+        low = neighbors * self.cell_size
+        high = low + self.cell_size - 1
+        points = colors[query]
+        gap = (np.maximum(low - points, 0) + np.maximum(points - high, 0)).sum(axis=1)
+        keep = (self.cube_counts()[cubes] > 0) & (gap <= best[query])
+        owners, candidates = self.cube_members(query[keep], cubes[keep])
+        if len(owners) == 0:
+            return
+        distances = np.abs(colors[owners] - self.colors[candidates]).sum(axis=1)
+        # (distance, index) pairs ordered as single integers
+        scale = len(self.colors)
+        keys = np.where(res < 0, INFINITY * scale, best.astype(np.int64) * scale + res)
+        np.minimum.at(keys, owners, distances.astype(np.int64) * scale + candidates)
+        found = keys < INFINITY * scale
+        best[found], res[found] = np.divmod(keys[found], scale)
@@ -0,0 +1,164 @@
+import numpy as np
+from PIL import Image
+
+from mosaicimage import resize
+from transition import HEIGHT, find_picture_in_mosaic, view_projection, zoom_out
+
+
+def pyramid(images):
+    """Mipmap levels of same sized PIL images, down to 1x1: one N×height×width×3
+    uint8 array per level, top line first
+    """
+    images = [image.convert("RGB") for image in images]
+    res = [np.stack([np.asarray(image) for image in images])]
+    while max(images[0].size) > 1:
+        width, height = images[0].size
+        images = [
+            image.resize(
+                (max(1, width // 2), max(1, height // 2)), Image.Resampling.BOX
+            )
+            for image in images
+        ]
+        res.append(np.stack([np.asarray(image) for image in images]))
+    return res
+
+
+def bilinear(level, layers, x, y):
+    """Colors of the points x, y of the images layers of a mipmap level, x and y
+    go from 0 to 1 from the top left corner of the images, edges are clamped
+    """
+    _, height, width, _ = level.shape
+    x = x * width - 0.5
+    y = y * height - 0.5
+    left = np.floor(x)
+    top = np.floor(y)
+    fx = (x - left)[:, np.newaxis]
+    fy = (y - top)[:, np.newaxis]
+    left = left.astype(np.intp)
+    top = top.astype(np.intp)
+    right = np.clip(left + 1, 0, width - 1)
+    bottom = np.clip(top + 1, 0, height - 1)
+    left = np.clip(left, 0, width - 1)
+    top = np.clip(top, 0, height - 1)
+    texels = level.reshape(-1, 3)
+    base = layers * (width * height)
+
+    def texel(row, column):
+        return texels[base + row * width + column].astype(np.float32)
+
+    upper = texel(top, left) * (1 - fx) + texel(top, right) * fx
+    lower = texel(bottom, left) * (1 - fx) + texel(bottom, right) * fx
+    return upper * (1 - fy) + lower * fy
+
+
+def trilinear(levels, layers, x, y, texels_per_pixel):
+    """Like bilinear() between the two mipmap levels closest to texels_per_pixel
+    of the first level, the same for all points
+    """
+    lod = np.clip(np.log2(max(texels_per_pixel, 1e-9)), 0, len(levels) - 1)
+    low = int(lod)
+    res = bilinear(levels[low], layers, x, y)
+    if lod > low:
+        res *= low + 1 - lod
+        res += bilinear(levels[low + 1], layers, x, y) * (lod - low)
+    return res
+
+
+class Scene(object):
+    """What the zoom out from start_picture to the mosaic of picture shows, as
+    drawn by display() of mosaic.py: mosaic is the lines of tiles from the top,
+    tiles are textured with their tile_size thumbnails and both photos are
+    decoded to fit the width×height frames.
+    """
+
+    def __init__(self, mosaic, start_picture, picture, width, height, tile_size):
+        self.width = width
+        self.height = height
+        self.ratio = picture.ratio
+        self.tiles = len(mosaic)
+        self.start_orientation = start_picture.orientation
+        self.orientation = picture.orientation
+        self.start_coord = find_picture_in_mosaic(start_picture, mosaic)
+        tiles = list({tile: None for line in mosaic for tile in line})
+        layers = {tile: i for i, tile in enumerate(tiles)}
+        # layers of the tiles, lines from the bottom
+        self.layers = np.array([[layers[tile] for tile in line] for line in mosaic])
+        self.layers = self.layers[::-1]
+        images = []
+        for tile in tiles:
+            with tile.resized(*tile_size) as image:
+                images.append(image.convert("RGB"))
+        self.tiles_levels = pyramid(images)
+        self.start_levels = self.decode(start_picture)
+        self.picture_levels = self.decode(picture)
+        self.projection = view_projection(width, height, self.ratio)
+        # normalized device coordinates of the centers of the pixels
+        x = (np.arange(width) + 0.5) / width * 2 - 1
+        y = 1 - (np.arange(height) + 0.5) / height * 2
+        self.x, self.y = (a.ravel() for a in np.meshgrid(x, y))
+
+    def decode(self, picture):
+        width = int(round(self.height * self.ratio))
+        with picture.open_image(width, self.height) as image:
+            return pyramid([resize(image, width, self.height, picture.draft)])
+
+    def render(self, progress):
+        """height×width×3 uint8 array of the frame at progress, from 0 to 1"""
+        zoom, alpha, transform = zoom_out(
+            progress,
+            self.ratio,
+            self.tiles,
+            self.start_coord,
+            self.start_orientation,
+            self.orientation,
+        )
+        # scene coordinates of the pixels inside the mosaic
+        inverse = np.linalg.inv(self.projection @ transform)
+        x = inverse[0, 0] * self.x + inverse[0, 1] * self.y + inverse[0, 3]
+        y = inverse[1, 0] * self.x + inverse[1, 1] * self.y + inverse[1, 3]
+        inside = np.flatnonzero(
+            (x >= 0) & (x < self.ratio * HEIGHT) & (y >= 0) & (y < HEIGHT)
+        )
+        x = x[inside]
+        y = y[inside]
+        size = HEIGHT / self.tiles
+        scene_per_pixel = HEIGHT / (zoom * self.height)
+        column = np.clip((x / (self.ratio * size)).astype(np.intp), 0, self.tiles - 1)
+        line = np.clip((y / size).astype(np.intp), 0, self.tiles - 1)
+        # float32 is precise enough inside a tile and twice as fast
+        u = (x / (self.ratio * size) - column).astype(np.float32)
+        v = (1 - (y / size - line)).astype(np.float32)
+        tile_height = self.tiles_levels[0].shape[1]
+        color = trilinear(
+            self.tiles_levels,
+            self.layers[line, column],
+            u,
+            v,
+            tile_height / size * scene_per_pixel,
+        )
+        color *= alpha
+        # the start picture is drawn over its tile once larger than the tiles
+        if zoom * size * self.height / HEIGHT > tile_height:
+            start = np.flatnonzero(
+                (column == self.start_coord[0]) & (line == self.start_coord[1])
+            )
+            color[start] *= 1 - alpha
+            color[start] += alpha * trilinear(
+                self.start_levels,
+                np.zeros(len(start), dtype=np.intp),
+                u[start],
+                v[start],
+                self.height / size * scene_per_pixel,
+            )
+        if alpha < 1.0:
+            color *= alpha
+            color += (1 - alpha) * trilinear(
+                self.picture_levels,
+                np.zeros(len(x), dtype=np.intp),
+                (x / (self.ratio * HEIGHT)).astype(np.float32),
+                (1 - y / HEIGHT).astype(np.float32),
+                self.height / HEIGHT * scene_per_pixel,
+            )
+        res = np.zeros((self.height * self.width, 3), dtype=np.uint8)
+        res[inside] = np.clip(np.round(color), 0, 255)
+        return res.reshape(self.height, self.width, 3)
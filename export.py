@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import argparse
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import makedirs, path, replace
+
+import numpy as np
+from PIL import Image
+
+from mosaicfactory import MosaicFactory, mosaic_strips, parallel_map, print_progress
+from options import create_mosaic_factory, library_options
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# EXIF orientation of each MosaicImage.orientation
+EXIF_ORIENTATIONS = {0: 1, 180: 3, 270: 6, 90: 8}
+
+parser = argparse.ArgumentParser(
+    description="Renders the mosaics of photos to large PNG files",
+    parents=[library_options],
+)
+parser.add_argument("output", type=str, help="folder where the mosaics are written")
+parser.add_argument(
+    "photos",
+    type=str,
+    nargs="*",
+    help="names of the photos of folder whose mosaics are rendered (defaults to all"
+    " of them)",
+)
+parser.add_argument(
+    "-W",
+    "--width",
+    type=int,
+    default=8192,
+    help="width in pixels of the mosaics, their height follows the photos ratio"
+    " (defaults to 8192)",
+)
+
+
+def png_chunk(kind, data):
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def up_filter(rows, previous):
+    """rows of bytes filtered with the PNG Up filter, previous is the row above
+    the first one
+    """
+    res = rows.copy()
+    res[1:] -= rows[:-1]
+    res[0] -= previous
+    return res
+
+
+class PNGWriter(object):
+    """Writes an 8 bits RGB PNG file strip by strip, only the last row and the
+    compressor state are kept between strips
+    """
+
+    def __init__(self, f, width, height, orientation=1, level=6):
+        self.f = f
+        self.compressor = zlib.compressobj(level)
+        self.previous = np.zeros(width * 3, dtype=np.uint8)
+        f.write(PNG_SIGNATURE)
+        f.write(
+            png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        )
+        if orientation != 1:
+            exif = Image.Exif()
+            exif[274] = orientation
+            # without the "Exif\0\0" header of JPEG files
+            f.write(png_chunk(b"eXIf", exif.tobytes()[6:]))
+
+    def write(self, strip):
+        rows = strip.reshape(len(strip), -1)
+        lines = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        # filter type of each line, Up compresses photos as well as Paeth here
+        # and is much faster
+        lines[:, 0] = 2
+        lines[:, 1:] = up_filter(rows, self.previous)
+        self.previous = rows[-1].copy()
+        data = self.compressor.compress(lines.tobytes())
+        if data:
+            self.f.write(png_chunk(b"IDAT", data))
+
+    def close(self):
+        self.f.write(png_chunk(b"IDAT", self.compressor.flush()))
+        self.f.write(png_chunk(b"IEND", b""))
+
+
+def export_mosaic(fpath, mosaic, width, height, orientation=0):
+    """Writes a width×height mosaic to the PNG file fpath, one line of tiles at a
+    time, the photo orientation is kept in its EXIF data
+    """
+    tmp_path = fpath + ".tmp"
+    with open(tmp_path, "wb") as f:
+        writer = PNGWriter(f, width, height, EXIF_ORIENTATIONS.get(orientation, 1))
+        for strip in mosaic_strips(mosaic, width, height):
+            writer.write(strip)
+        writer.close()
+    replace(tmp_path, fpath)
+
+
+def main():
+    args = parser.parse_args()
+    mosaic_factory = create_mosaic_factory(args)
+    print("loading photos:")
+    mosaic_factory.load(args.folder, args.jobs, print_progress)
+    images = mosaic_factory.image_list
+    if args.photos:
+        names = set(args.photos)
+        images = [img for img in images if path.basename(img.path) in names]
+        files = set(MosaicFactory.list_image_files(args.folder))
+        for name in sorted(names - files):
+            print("skipping {}: it isn't a photo of the folder".format(name))
+        for name in sorted(names & files - {path.basename(img.path) for img in images}):
+            print(
+                "skipping {}: it isn't one of the photos having the most common"
+                " ratio in the folder".format(name)
+            )
+    print("calculating mosaics:")
+    if args.photos:
+        # only the mosaics of the selected photos
+        mosaics = []
+        for i, img in enumerate(images):
+            mosaics.append(mosaic_factory.cached_mosaic(img, args.tiles, args.reuse))
+            print_progress("mosaics", i + 1, len(images))
+    else:
+        array = mosaic_factory.all_mosaics(
+            args.tiles, args.reuse, partial(print_progress, "mosaics")
+        )
+        mosaics = [
+            mosaic_factory.tiles_images(array[mosaic_factory.positions[img.hash]])
+            for img in images
+        ]
+    width = args.width
+    height = int(round(width / mosaic_factory.ratio))
+    makedirs(args.output, exist_ok=True)
+    jobs = [
+        (
+            path.join(args.output, path.splitext(path.basename(img.path))[0] + ".png"),
+            mosaic,
+            width,
+            height,
+            img.orientation,
+        )
+        for img, mosaic in zip(images, mosaics)
+    ]
+    print("rendering {} mosaics of {}x{} pixels:".format(len(jobs), width, height))
+    with ProcessPoolExecutor(args.jobs) as executor:
+        parallel_map(
+            executor, export_mosaic, jobs, partial(print_progress, "rendering")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import numpy as np
+
+# side of the sub-grid of CIELAB colors describing each cell with each metric,
+# rgb compares the average sRGB colors of the cells
+METRICS = {"rgb": None, "lab": 1, "lab2x2": 2, "lab3x3": 3}
+# linear sRGB to CIE XYZ, D65 white point
+RGB_TO_XYZ = np.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+WHITE = np.array([0.95047, 1.0, 1.08883])
+EPSILON = (6 / 29) ** 3
+
+
+def srgb_to_lab(colors):
+    """CIELAB colors of an array of 8 bits sRGB colors, as float32"""
+    rgb = np.asarray(colors, dtype=np.float64) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ RGB_TO_XYZ.T / WHITE
+    f = np.where(xyz > EPSILON, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lab = np.stack(
+        [
+            116 * f[..., 1] - 16,
+            500 * (f[..., 0] - f[..., 1]),
+            200 * (f[..., 1] - f[..., 2]),
+        ],
+        axis=-1,
+    )
+    return lab.astype(np.float32)
+
+
+def grid_features(grid, cells):
+    """Descriptors of the cells of a (side × cells)² RGB grid: one line of the
+    CIELAB colors of its cells×cells sub-grid per cell, cells in lines from the top
+    """
+    side = len(grid) // cells
+    lab = srgb_to_lab(grid).reshape(side, cells, side, cells, 3)
+    return lab.transpose(0, 2, 1, 3, 4).reshape(side * side, cells * cells * 3)
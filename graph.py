@@ -1,112 +1,330 @@
 #!/usr/bin/env python
 
-import json
-from os import makedirs, path
+import threading
+from collections import deque
+from functools import partial
 
-from pygraph.algorithms.accessibility import mutual_accessibility
-from pygraph.classes.digraph import digraph
-from pygraph.classes.exceptions import AdditionError
+import numpy as np
 
-from cache import CACHE_DIR
-from mosaicfactory import MosaicFactory
+from instrumentation import timed
+from mosaicfactory import MosaicFactory, print_progress
 
+# mosaics whose edges are deduplicated together
+GRAPH_BATCH_SIZE = 256
 
-def serialize_digraph(gr):
-    return {
-        "edges": [[edge[0].hash, edge[1].hash] for edge in gr.edges()],
-    }
 
+class Digraph(object):
+    """Directed graph of images in compressed sparse row form: nodes are numbered
+    in the order of the nodes list and the successors of node i are
+    targets[offsets[i]:offsets[i + 1]], sorted and without duplicates.
+    """
+
+    def __init__(self, nodes, sources, targets):
+        self.nodes = list(nodes)
+        count = len(self.nodes)
+        edges = np.unique(
+            np.asarray(sources, dtype=np.int64) * count
+            + np.asarray(targets, dtype=np.int64)
+        )
+        sources, self.targets = np.divmod(edges, count)
+        self.offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=count), out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def successors(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.targets[start:end]
+
+    def edges(self):
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.offsets))
+        return [
+            (self.nodes[source], self.nodes[target])
+            for source, target in zip(sources.tolist(), self.targets.tolist())
+        ]
 
-def deserialize_digraph(data, images):
-    gr = digraph()
-    gr.add_nodes(images.values())
-    for edge in data["edges"]:
-        img0 = images[edge[0]]
-        img1 = images[edge[1]]
-        gr.add_edge((img0, img1))
-    return gr
+    def subgraph(self, ids):
+        """Graph of the nodes ids and of the edges between them"""
+        ids = np.asarray(ids, dtype=np.int64)
+        renumbered = np.full(len(self.nodes), -1, dtype=np.int64)
+        renumbered[ids] = np.arange(len(ids))
+        sources = np.repeat(renumbered, np.diff(self.offsets))
+        targets = renumbered[self.targets]
+        kept = (sources >= 0) & (targets >= 0)
+        return Digraph(
+            [self.nodes[i] for i in ids.tolist()], sources[kept], targets[kept]
+        )
+
+
+def strongly_connected_components(offsets, targets):
+    """Component label of each node of a graph in compressed sparse row form,
+    with an iterative Tarjan algorithm.
+    """
+    offsets = offsets.tolist()
+    targets = targets.tolist()
+    count = len(offsets) - 1
+    index = [-1] * count
+    low = [0] * count
+    on_stack = [False] * count
+    labels = [-1] * count
+    stack = []
+    visited = 0
+    components = 0
+    for root in range(count):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = visited
+        visited += 1
+        stack.append(root)
+        on_stack[root] = True
+        # nodes being explored with the position of their next edge
+        path = [[root, offsets[root]]]
+        while path:
+            node, edge = path[-1]
+            end = offsets[node + 1]
+            while edge < end:
+                successor = targets[edge]
+                edge += 1
+                if index[successor] == -1:
+                    path[-1][1] = edge
+                    index[successor] = low[successor] = visited
+                    visited += 1
+                    stack.append(successor)
+                    on_stack[successor] = True
+                    path.append([successor, offsets[successor]])
+                    break
+                if on_stack[successor] and index[successor] < low[node]:
+                    low[node] = index[successor]
+            else:
+                path.pop()
+                if low[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        labels[member] = components
+                        if member == node:
+                            break
+                    components += 1
+                if path and low[node] < low[path[-1][0]]:
+                    low[path[-1][0]] = low[node]
+    return np.array(labels, dtype=np.int64)
+
+
+@timed("transition graph")
+def graph_from_array(nodes, tiles):
+    """Graph of the edges leading from tiles to the images of their mosaics,
+    tiles[i] being the mosaic of nodes[i] as positions in nodes
+    """
+    count = len(nodes)
+    sources = [np.empty(0, dtype=np.int64)]
+    targets = [np.empty(0, dtype=np.int64)]
+    for start in range(0, count, GRAPH_BATCH_SIZE):
+        batch = np.asarray(tiles[start:][:GRAPH_BATCH_SIZE], dtype=np.int64)
+        batch = batch.reshape(len(batch), -1)
+        images = np.arange(start, start + len(batch), dtype=np.int64)
+        edges = np.unique(images[:, np.newaxis] * count + batch)
+        images, tiles_positions = np.divmod(edges, count)
+        sources.append(tiles_positions)
+        targets.append(images)
+    return Digraph(nodes, np.concatenate(sources), np.concatenate(targets))
+
+
+def serialize_digraph(gr):
+    return [(edge[0].hash, edge[1].hash) for edge in gr.edges()]
 
 
 def load_from_cache(mosaic_factory, nb_segments, reuse=True):
-    dir = path.join(
-        CACHE_DIR, "mosaics", mosaic_factory.hash(), str(nb_segments), str(reuse)
-    )
-    fpath = path.join(dir, "graph.json")
-    try:
-        with open(fpath, "r") as f:
-            return deserialize_digraph(json.load(f), mosaic_factory.images)
-    except (IOError, json.JSONDecodeError):
-        gr = transition_graph(mosaic_factory, nb_segments, reuse)
-        makedirs(dir, exist_ok=True)
-        with open(fpath, "w") as f:
-            json.dump(serialize_digraph(gr), f)
-        return gr
+    """Transition graph built from the cached mosaics, the missing ones are
+    computed first
+    """
+    array = mosaic_factory.mosaic_array(nb_segments, reuse)
+    if not array.complete():
+        return transition_graph(mosaic_factory, nb_segments, reuse)
+    return graph_from_array(mosaic_factory.image_list, array.tiles)
 
 
 def transition_graph(mosaic_factory, nb_segments, reuse=True):
-    gr = digraph()
-    gr.add_nodes(mosaic_factory.images.values())
     print("calculating transition graph:")
-    for i, img in enumerate(mosaic_factory.images.values()):
-        print(" {0}/{1}".format(i + 1, len(mosaic_factory.images)))
-        for line in mosaic_factory.cached_mosaic(img, nb_segments, reuse):
-            for pic in line:
-                try:
-                    gr.add_edge((pic, img))
-                except AdditionError:
-                    pass
-    return gr
+    array = mosaic_factory.all_mosaics(
+        nb_segments, reuse, partial(print_progress, "mosaics")
+    )
+    return graph_from_array(mosaic_factory.image_list, array.tiles)
 
 
+@timed("strongly connected component")
 def biggest_strongly_connected_component(g):
-    ma = mutual_accessibility(g)
-    max_component = []
-    for component in ma.values():
-        if len(component) > len(max_component):
-            max_component = component
-    g2 = digraph()
-    g2.add_nodes(max_component)
-    for edge in g.edges():
-        if edge[0] in max_component and edge[1] in max_component:
-            g2.add_edge(edge)
-    return g2
-
-
-def init_visited(g):
-    for node in g.nodes():
-        g.add_node_attribute(node, ("visited", 0))
-
-
-def next_node(g, node):
-    next = None
-    min_visited = float("inf")
-    for n in g.neighbors(node):
-        if g.node_attributes(n)[0][1] < min_visited:
-            min_visited = g.node_attributes(n)[0][1]
-            next = n
-    g.node_attributes(next)[0] = ("visited", g.node_attributes(next)[0][1] + 1)
-    return next
+    labels = strongly_connected_components(g.offsets, g.targets)
+    # the lowest label wins ties
+    biggest = np.bincount(labels).argmax()
+    return g.subgraph(np.flatnonzero(labels == biggest))
+
+
+class Walk(object):
+    """Walk through a graph going to the least visited successor at each step, the
+    one with the lowest id on ties. Visits are counted in a dense array and each
+    step is a single vectorized scan of the successors of the current node.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.visited = np.zeros(len(graph), dtype=np.int64)
+        self.successors = np.split(graph.targets, graph.offsets[1:-1])
+
+    def next(self, node):
+        """Id of the successor of node id to go to, which is then visited"""
+        successors = self.successors[node]
+        next = int(successors[self.visited[successors].argmin()])
+        self.visited[next] += 1
+        return next
+
+    def path(self, node, steps):
+        """Ids of the nodes visited by the next steps from node id"""
+        res = np.empty(steps, dtype=np.int64)
+        for i in range(steps):
+            node = res[i] = self.next(node)
+        return res
 
 
 def image_iterator(mosaic_factory, nb_segments, reuse=True):
     gr = load_from_cache(mosaic_factory, nb_segments, reuse)
     c = biggest_strongly_connected_component(gr)
-    init_visited(c)
+    walk = Walk(c)
 
-    def it(graph, node):
+    def it(node):
+        # the start node is visited too, a self-loop mustn't lead back to it first
+        walk.visited[node] += 1
         while True:
-            yield node
-            node = next_node(graph, node)
+            yield c.nodes[node]
+            node = walk.next(node)
+
+    return it(0)
+
+
+class Lookahead(object):
+    """Iterator wrapper able to peek at the next items, from several threads"""
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.buffer = deque()
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return self.buffer.popleft() if self.buffer else next(self.iterator)
+
+    def peek(self, count):
+        with self.lock:
+            while len(self.buffer) < count:
+                self.buffer.append(next(self.iterator))
+            return list(self.buffer)[:count]
+
+
+class ProgressiveWalk(object):
+    """Walk through a transition graph that grows while mosaics are computed by
+    another thread. Steps prefer the least visited successor like Walk, in the
+    biggest strongly connected component known at that time: when the walk
+    is outside of it, it follows the shortest path leading to it if any, or
+    stays in its own component.
+    """
 
-    return it(c, c.nodes()[0])
+    def __init__(self):
+        self.lock = threading.Lock()
+        # node to its successors, in the order they were added
+        self.successors = {}
+        self.components = {}
+        self.component = set()
+        self.updated = False
+        self.visited = {}
+
+    def add_mosaic(self, img, mosaic):
+        with self.lock:
+            self.successors.setdefault(img, {})
+            for line in mosaic:
+                for pic in line:
+                    self.successors.setdefault(pic, {})[img] = None
+            self.updated = True
+
+    def update_components(self):
+        if self.updated:
+            self.updated = False
+            nodes = list(self.successors)
+            ids = {node: i for i, node in enumerate(nodes)}
+            graph = Digraph(
+                nodes,
+                np.repeat(
+                    np.arange(len(nodes)), [len(s) for s in self.successors.values()]
+                ),
+                [ids[n] for successors in self.successors.values() for n in successors],
+            )
+            labels = strongly_connected_components(graph.offsets, graph.targets)
+            members = [set() for _ in range(labels.max() + 1)]
+            for node, label in zip(nodes, labels.tolist()):
+                members[label].add(node)
+            self.components = {
+                node: members[label] for node, label in zip(nodes, labels.tolist())
+            }
+            self.component = members[np.bincount(labels).argmax()]
+
+    def ready(self):
+        """True once at least one transition can be taken."""
+        with self.lock:
+            self.update_components()
+            return len(self.component) > 1
+
+    def step_towards(self, node, targets):
+        previous = {node: None}
+        queue = deque([node])
+        while queue:
+            current = queue.popleft()
+            for n in self.successors[current]:
+                if n in previous:
+                    continue
+                previous[n] = current
+                if n in targets:
+                    while previous[n] is not node:
+                        n = previous[n]
+                    return n
+                queue.append(n)
+        return None
+
+    def next(self, node):
+        with self.lock:
+            self.update_components()
+            targets = self.component
+            if node not in targets:
+                next = self.step_towards(node, targets)
+                targets = {next} if next is not None else set(self.components[node])
+            next = None
+            min_visited = float("inf")
+            for n in self.successors[node]:
+                if n in targets and self.visited.get(n, 0) < min_visited:
+                    min_visited = self.visited.get(n, 0)
+                    next = n
+            self.visited[next] = self.visited.get(next, 0) + 1
+            return next
+
+    def iterator(self):
+        with self.lock:
+            self.update_components()
+            node = min(self.component)
+            self.visited[node] = self.visited.get(node, 0) + 1
+        while True:
+            yield node
+            node = self.next(node)
 
 
 if __name__ == "__main__":
     from sys import argv
 
-    from pygraph.readwrite.dot import write
-
-    mosaic_factory = MosaicFactory.load(argv[1])
+    mosaic_factory = MosaicFactory()
+    mosaic_factory.load(argv[1])
     gr = load_from_cache(mosaic_factory, 4)
     with open("test.dot", "w") as _file:
-        _file.write(write(gr))
+        _file.write("digraph graphname {\n")
+        for source, target in serialize_digraph(gr):
+            _file.write('"{}" -> "{}";\n'.format(source, target))
+        _file.write("}\n")
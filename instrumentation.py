@@ -0,0 +1,152 @@
+import csv
+import functools
+import json
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# durations kept by each timer for its percentiles
+TIMER_SAMPLES = 10000
+# timed events kept for the trace
+TRACE_EVENTS = 100000
+
+
+class Timer(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=TIMER_SAMPLES)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.samples.append(duration)
+
+    def percentiles(self, last=None):
+        """p50, p99 and maximum of the last durations, in seconds"""
+        samples = list(self.samples)[-last:] if last else list(self.samples)
+        if not samples:
+            return 0.0, 0.0, 0.0
+        p50, p99 = np.percentile(samples, [50, 99])
+        return float(p50), float(p99), max(samples)
+
+
+class Instrumentation(object):
+    """Named timers and counters shared by all threads. Timers keep the total and
+    the last TIMER_SAMPLES durations of what they time, the trace keeps the last
+    TRACE_EVENTS timed events.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.timers = {}
+        self.counters = Counter()
+        self.events = deque(maxlen=TRACE_EVENTS)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def record(self, name, start, duration):
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = Timer()
+            self.timers[name].add(duration)
+            self.events.append(
+                (name, threading.current_thread().name, start - self.origin, duration)
+            )
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def percentiles(self, name, last=None):
+        with self.lock:
+            timer = self.timers.get(name)
+            return (0.0, 0.0, 0.0) if timer is None else timer.percentiles(last)
+
+    def summary(self):
+        """Counters and, for each timer, its count and its total, p50, p99 and
+        maximum durations in milliseconds
+        """
+        with self.lock:
+            timers = {}
+            for name, timer in self.timers.items():
+                p50, p99, maximum = timer.percentiles()
+                timers[name] = {
+                    "count": timer.count,
+                    "total": timer.total * 1000,
+                    "p50": p50 * 1000,
+                    "p99": p99 * 1000,
+                    "max": maximum * 1000,
+                }
+            return {"timers": timers, "counters": dict(self.counters)}
+
+    def dump(self, fpath):
+        """Writes the summary and the trace as JSON, or as CSV if fpath ends with
+        .csv: one row per counter, timer and event, times are in milliseconds
+        """
+        summary = self.summary()
+        with self.lock:
+            events = list(self.events)
+        if not fpath.lower().endswith(".csv"):
+            with open(fpath, "w") as f:
+                json.dump(
+                    dict(
+                        summary,
+                        events=[
+                            {
+                                "name": name,
+                                "thread": thread,
+                                "start": start * 1000,
+                                "duration": duration * 1000,
+                            }
+                            for name, thread, start, duration in events
+                        ],
+                    ),
+                    f,
+                    indent=1,
+                )
+            return
+        with open(fpath, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ["type", "name", "thread", "start", "duration", "value"]
+                + ["count", "total", "p50", "p99", "max"]
+            )
+            for name, value in sorted(summary["counters"].items()):
+                writer.writerow(["counter", name, "", "", "", value])
+            for name, stats in sorted(summary["timers"].items()):
+                writer.writerow(
+                    ["timer", name, "", "", "", ""]
+                    + [stats[key] for key in ("count", "total", "p50", "p99", "max")]
+                )
+            for name, thread, start, duration in events:
+                writer.writerow(
+                    ["event", name, thread, start * 1000, duration * 1000, ""]
+                )
+
+
+instrumentation = Instrumentation()
+
+
+def timed(name):
+    """Decorator recording the duration of each call in the timer name"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with instrumentation.timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import argparse
+from os import listdir, path, walk
+
+from store import Store
+from thumbnails import Thumbnails
+
+parser = argparse.ArgumentParser(description="Maintains the cache of the mosaics")
+commands = parser.add_subparsers(dest="command", required=True)
+gc_parser = commands.add_parser(
+    "gc",
+    help="remove the mosaics of libraries replaced by a newer one of their folder or"
+    " whose folder is gone, the thumbnails and metadata of photos in none of the"
+    " remaining libraries and the least recently used thumbnails beyond the budget",
+)
+gc_parser.add_argument(
+    "--thumbnails-budget",
+    type=int,
+    default=1024,
+    help="megabytes of thumbnails kept (defaults to 1024)",
+)
+gc_parser.add_argument(
+    "-n",
+    "--dry-run",
+    action="store_true",
+    help="only tell what would be removed",
+)
+
+
+def directory_size(dir):
+    return sum(
+        path.getsize(path.join(root, name))
+        for root, _, names in walk(dir)
+        for name in names
+    )
+
+
+def print_removed(what, count, size):
+    print(" {} {}: {:.1f} MB".format(count, what, size / 2**20))
+
+
+def gc(args):
+    store = Store()
+    thumbnails = Thumbnails(budget=args.thumbnails_budget * 2**20)
+    current = {}
+    for library, folder in store.libraries():
+        current[folder] = library
+    kept = {library for folder, library in current.items() if path.isdir(folder)}
+    mosaics_dir = path.join(store.dir, "mosaics")
+    stale = {library for library, _ in store.libraries()}
+    stale.update(listdir(mosaics_dir) if path.isdir(mosaics_dir) else [])
+    stale -= kept
+    size = sum(directory_size(store.mosaics_dir(library)) for library in stale)
+    if not args.dry_run:
+        store.remove_libraries(stale)
+    print("removed:" if not args.dry_run else "would remove:")
+    print_removed("libraries mosaics", len(stale), size)
+    hashes = set()
+    for library in kept:
+        hashes.update(store.library_images(library))
+    orphans = [h for h in thumbnails.hashes() if h not in hashes]
+    count, size = thumbnails.remove_hashes(orphans, args.dry_run)
+    print_removed("thumbnails of photos in no library", count, size)
+    # the analysis of the other files of the remaining folders is kept, they may
+    # have another ratio than the photos of their library
+    folders = {folder for folder, library in current.items() if library in kept}
+    gone = set()
+    for fpath, h in store.fingerprinted_files():
+        if path.dirname(fpath) in folders and path.isfile(fpath):
+            hashes.add(h)
+        else:
+            gone.add(fpath)
+    forgotten = store.image_hashes() - hashes
+    if not args.dry_run:
+        store.remove_images(forgotten, gone)
+    print(
+        " metadata of {} photos and fingerprints of {} files".format(
+            len(forgotten), len(gone)
+        )
+    )
+    count, size = thumbnails.remove_files(thumbnails.legacy_files(), args.dry_run)
+    print_removed("thumbnails of former versions", count, size)
+    if args.dry_run:
+        # the files above are still there
+        return
+    count, size = thumbnails.trim()
+    print_removed("least recently used thumbnails", count, size)
+
+
+def main():
+    args = parser.parse_args()
+    if args.command == "gc":
+        gc(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,138 @@
 import functools
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """Values by key, the least recently used ones are evicted beyond max_size
+    values or max_bytes bytes as measured by sizeof(value). Both are unbounded by
+    default. Counts hits, misses and evictions. The cache can be shared by several
+    threads if thread_safe is set.
+    """
+
+    def __init__(
+        self, max_size=None, max_bytes=None, sizeof=sys.getsizeof, thread_safe=False
+    ):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.lock = threading.Lock() if thread_safe else nullcontext()
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.values
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.values.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.values.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = 0 if self.max_bytes is None else self.sizeof(value)
+        with self.lock:
+            if key in self.values:
+                self.bytes -= self.sizes.pop(key)
+            self.values[key] = value
+            self.values.move_to_end(key)
+            self.sizes[key] = size
+            self.bytes += size
+            # the last value is kept even if it is larger than max_bytes alone
+            while len(self.values) > 1 and (
+                (self.max_size is not None and len(self.values) > self.max_size)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                evicted, _ = self.values.popitem(last=False)
+                self.bytes -= self.sizes.pop(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.values),
+                "bytes": self.bytes,
+            }
 
 
 class memoized(object):
     """Decorator that caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
-    not re-evaluated.
+    not re-evaluated. Values are kept in an LRUCache built from the decorator
+    arguments: @memoized is unbounded, @memoized(max_size=100) keeps the last 100.
+    Each instance has its own cache for a decorated method, which goes away with
+    it, see caches(). Concurrent calls with the same arguments may all evaluate
+    the function.
     """
 
-    def __init__(self, func):
+    def __init__(self, func=None, **options):
         self.func = func
-        self.cache = {}
+        self.options = options
+        self.name = None
+        self.cache = LRUCache(**options)
+        if func is not None:
+            functools.update_wrapper(self, func)
 
     def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # @memoized(...) decorating args[0]
+            return memoized(args[0], **self.options)
         try:
-            return self.cache[(args, tuple(sorted(kwargs.items())))]
-        except KeyError:
-            value = self.func(*args, **kwargs)
-            self.cache[(args, tuple(sorted(kwargs.items())))] = value
-            return value
+            key = (args, tuple(sorted(kwargs.items())))
+            value = self.cache.get(key, MISSING)
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
             # Better to not cache than to blow up entirely.
             return self.func(*args, **kwargs)
+        if value is MISSING:
+            value = self.func(*args, **kwargs)
+            self.cache.put(key, value)
+        return value
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        """Support instance methods: the method bound to obj is memoized in its
+        own cache and stored in obj.__dict__, where next lookups find it.
+        """
+        if obj is None:
+            return self
+        bound = memoized(self.func.__get__(obj, objtype), **self.options)
+        obj.__dict__[self.name] = bound
+        return bound
+
 
-    def __get__(self, obj, objtype):
-        """Support instance methods."""
-        return functools.partial(self.__call__, obj)
+def caches(obj):
+    """dict of the name of each memoized method of obj to its LRUCache"""
+    return {
+        name: getattr(obj, name).cache
+        for cls in type(obj).__mro__
+        for name, value in vars(cls).items()
+        if isinstance(value, memoized)
+    }
@@ -3,72 +3,60 @@
 import argparse
 import ctypes
 import sys
+import threading
+import time
 from contextlib import contextmanager
-from math import exp, sqrt
+from functools import partial
+from math import sqrt
 
 import sdl2
 from OpenGL.GL import (
     GL_BLEND,
-    GL_CLAMP,
     GL_COLOR_BUFFER_BIT,
-    GL_COMPILE,
-    GL_DECAL,
-    GL_FLAT,
-    GL_MODELVIEW,
-    GL_NEAREST,
     GL_ONE_MINUS_SRC_ALPHA,
-    GL_PROJECTION,
-    GL_QUADS,
-    GL_REPEAT,
-    GL_RGBA,
     GL_SRC_ALPHA,
-    GL_TEXTURE_2D,
-    GL_TEXTURE_ENV,
-    GL_TEXTURE_ENV_MODE,
-    GL_TEXTURE_MAG_FILTER,
-    GL_TEXTURE_MIN_FILTER,
-    GL_TEXTURE_WRAP_S,
-    GL_TEXTURE_WRAP_T,
-    GL_UNPACK_ALIGNMENT,
-    GL_UNSIGNED_BYTE,
-    glBegin,
-    glBindTexture,
     glBlendFunc,
-    glCallList,
     glClear,
     glClearColor,
-    glColor4f,
     glEnable,
-    glEnd,
-    glEndList,
-    glGenLists,
-    glGenTextures,
-    glLoadIdentity,
-    glMatrixMode,
-    glNewList,
-    glOrtho,
-    glPixelStorei,
-    glPopMatrix,
-    glPushMatrix,
-    glRotatef,
-    glScalef,
-    glShadeModel,
-    glTexCoord2f,
-    glTexEnvf,
-    glTexImage2D,
-    glTexParameterf,
-    glTranslatef,
-    glVertex2f,
     glViewport,
 )
+from PIL import Image, ImageDraw, ImageFont
+
+from atlas import tile_size
+from graph import Lookahead, ProgressiveWalk, image_iterator
+from instrumentation import instrumentation
+from memoized import caches, memoized
+from mosaicfactory import print_progress
+from options import (
+    create_mosaic_factory,
+    library_options,
+    thumbnails_options,
+    walk_options,
+)
+from prefetch import Prefetcher
+from renderer import Renderer, picture_data, tile_data
+from tour import tour_iterator
+from transition import (
+    HEIGHT,
+    find_picture_in_mosaic,
+    scaling,
+    view_projection,
+    zoom_out,
+)
 
-from graph import image_iterator
-from mosaicfactory import MosaicFactory
-
-parser = argparse.ArgumentParser(description="Photos mosaic visualization")
-parser.add_argument("folder", type=str, help="folder containing photos")
-parser.add_argument(
-    "-t", "--tiles", type=int, default=40, help="number of tiles in each mosaic"
+# prefetched tiles uploaded at each frame
+PREFETCH_TILES = 64
+# bytes of decoded tiles kept in memory, tiles evicted from the atlas are
+# uploaded again from there
+TILES_CACHE_BYTES = 64 * 2**20
+# seconds between two updates of the HUD and number of frames it describes
+HUD_REFRESH = 0.5
+HUD_FRAMES = 120
+
+parser = argparse.ArgumentParser(
+    description="Photos mosaic visualization",
+    parents=[library_options, thumbnails_options, walk_options],
 )
 parser.add_argument(
     "-p",
@@ -77,28 +65,47 @@ parser.add_argument(
     default=640 * 480,
     help="maximum number of pixels for each texture (defaults to 640x480)",
 )
+parser.add_argument(
+    "--tile-pixels",
+    type=int,
+    default=64,
+    help="height in pixels of the tiles textures packed in the atlas (defaults to 64)",
+)
+parser.add_argument(
+    "--vram-budget",
+    type=int,
+    default=256,
+    help="megabytes of textures and mosaics kept on the GPU, least recently used"
+    " ones are unloaded beyond it (defaults to 256)",
+)
+parser.add_argument(
+    "--prefetch",
+    type=int,
+    default=2,
+    help="number of upcoming photos of the walk loaded in advance (defaults to 2)",
+)
 parser.add_argument(
     "-d", "--duration", type=float, default=10.0, help="zooming out duration in seconds"
 )
 parser.add_argument(
-    "-n",
-    "--no-reuse",
-    dest="reuse",
-    action="store_false",
-    help="a tile can only be used once in a photo (this requires that tiles²"
-    " <= #photos in folder",
+    "--hud",
+    action="store_true",
+    help="show frame times, GPU cache hits and uploads on top of the photos",
+)
+parser.add_argument(
+    "--trace",
+    type=str,
+    default=None,
+    metavar="FILE",
+    help="write timers, counters and the last timed events to FILE at exit, as CSV"
+    " if its name ends with .csv or as JSON otherwise",
+)
+parser.add_argument(
+    "--progressive",
+    action="store_true",
+    help="open the window right away and start with the photos whose mosaics are"
+    " cached while the others are computed in the background",
 )
-
-
-def find_picture_in_mosaic(picture, mosaic):
-    x = -1
-    for y, line in enumerate(mosaic):
-        if picture in line:
-            x = line.index(picture)
-            break
-    if x == -1:
-        raise Exception("picture not in mosaic")
-    return (x, len(mosaic) - y - 1)
 
 
 @contextmanager
@@ -115,197 +122,337 @@ def limit_pixels_count(img, limit):
             yield image
 
 
-def load_texture(img):
-    with limit_pixels_count(img, args.pixels_limit) as image:
-        width, height = image.size
-        image = image.tobytes("raw", "RGBX", 0, -1)
-        # Create Texture
-        _id = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, _id)
+def get_picture_data(picture):
+    with instrumentation.timer("texture decoding"):
+        with limit_pixels_count(picture, args.pixels_limit) as image:
+            return picture_data(image)
 
-        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
-        glTexImage2D(
-            GL_TEXTURE_2D, 0, 3, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, image
-        )
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-    glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_DECAL)
-    return _id
-
-
-def generate_picture_display_list(picture, width, height):
-    dl = glGenLists(1)
-    picture_display_lists[picture] = dl
-    glNewList(dl, GL_COMPILE)
-    draw_picture(picture, 0, 0, width, height)
-    glEndList()
-
-
-def generate_mosaic_display_list(picture):
-    dl = glGenLists(1)
-    mosaic_display_lists[picture] = dl
-    glNewList(dl, GL_COMPILE)
-    draw_mosaic(picture)
-    glEndList()
-
-
-def draw_mosaic(picture):
-    m = mosaic_factory.cached_mosaic(picture, args.tiles, args.reuse)
-    for column in range(args.tiles):
-        for line in range(args.tiles):
-            glPushMatrix()
-            glTranslatef(column * mosaic_factory.ratio * size, line * size, 0.0)
-            glCallList(picture_display_lists[m[args.tiles - 1 - line][column]])
-            glPopMatrix()
-
-
-def draw_picture(picture, x, y, width, height):
-    glBindTexture(GL_TEXTURE_2D, textures[picture])
-    glPushMatrix()
-    glTranslatef(x, y, 0.0)
-    glBegin(GL_QUADS)
-    # Bottom Left Of The Texture and Quad:
-    glTexCoord2f(0.0, 0.0)
-    glVertex2f(0, 0)
-    # Bottom Right Of The Texture and Quad:
-    glTexCoord2f(1.0, 0.0)
-    glVertex2f(width, 0)
-    # Top Right Of The Texture and Quad:
-    glTexCoord2f(1.0, 1.0)
-    glVertex2f(width, height)
-    # Top Left Of The Texture and Quad:
-    glTexCoord2f(0.0, 1.0)
-    glVertex2f(0, height)
-    glEnd()
-    glPopMatrix()
-
-
-def sigmoid(value):
-    return 1.0 / (1.0 + exp(-float(value)))
-
-
-def sigmoid_0_1(value):
-    return sigmoid(value * 12.0 - 6.0)
-
-
-def fake_sigmoid(value):
-    if value == 0.0 or value == 1.0:
-        return value
-    delta = sigmoid_0_1(1) - sigmoid_0_1(0)
-    res = sigmoid_0_1(value) / delta - sigmoid_0_1(0)
-    if res < 0.0:
-        return 0.0
-    elif res > 1.0:
-        return 1.0
-    else:
-        return res
 
+@memoized(
+    max_bytes=TILES_CACHE_BYTES,
+    sizeof=lambda levels: sum(level.nbytes for level in levels),
+    thread_safe=True,
+)
+def get_tile_data(picture):
+    with instrumentation.timer("tile decoding"):
+        size = tile_size(mosaic_factory.ratio, args.tile_pixels)
+        with picture.resized(*size) as image:
+            return tile_data(image)
 
-def angle_difference(a1, a2):
-    difference = a1 - a2
-    if abs(difference) > 180:
-        difference = difference % 180
-        if a1 > a2:
-            difference = -difference
-    return difference
 
+def get_prepared_tile_data(picture):
+    return prefetcher.take_tile(picture)
 
-def display():
-    start_point = (
-        start_picture_coord[0] * HEIGHT * mosaic_factory.ratio / (args.tiles - 1),
-        start_picture_coord[1] * HEIGHT / (args.tiles - 1),
+
+def get_any_tile_data(picture):
+    data = prefetcher.take_tile(picture)
+    return get_tile_data(picture) if data is None else data
+
+
+def load_picture(picture):
+    """Uploads the texture of picture, decoding it unless it was prefetched"""
+    if not renderer.lookup("texture", picture):
+        data = prefetcher.take_texture(picture)
+        if data is None:
+            data = get_picture_data(picture)
+        with instrumentation.timer("texture upload"):
+            renderer.load_picture(picture, data)
+
+
+def load_mosaic(picture):
+    if not renderer.lookup("mosaic", picture):
+        with instrumentation.timer("mosaic upload"):
+            renderer.load_mosaic(picture, get_mosaic(picture), get_any_tile_data)
+
+
+def prepare_thumbnails():
+    print("preparing thumbnails:")
+    mosaic_factory.prepare_thumbnails(
+        *tile_size(mosaic_factory.ratio, args.tile_pixels),
+        args.jobs,
+        partial(print_progress, "thumbnails"),
     )
-    center = (HEIGHT * mosaic_factory.ratio / 2.0, HEIGHT / 2.0)
-    reverse_sigmoid_progress = fake_sigmoid(1 - progress)
-    sigmoid_progress = 1 - reverse_sigmoid_progress
-    max_zoom = args.tiles
-    zoom = max_zoom**reverse_sigmoid_progress
-    angle = start_orientation + sigmoid_progress * angle_difference(
-        current_mosaic_picture.orientation, start_orientation
+    threading.Thread(target=mosaic_factory.thumbnails.trim, daemon=True).start()
+
+
+def prefetch():
+    """Uploads a part of what the prefetcher prepared for the next photos of the
+    walk: at most one texture or PREFETCH_TILES tiles per frame.
+    """
+    for picture in prefetcher.upcoming():
+        if not renderer.lookup("mosaic", picture, prefetch=True):
+            with instrumentation.timer("mosaic upload"):
+                renderer.load_mosaic(
+                    picture,
+                    get_mosaic(picture),
+                    get_prepared_tile_data,
+                    PREFETCH_TILES,
+                )
+            return
+        if not renderer.lookup("texture", picture, prefetch=True):
+            data = prefetcher.take_texture(picture)
+            if data is not None:
+                with instrumentation.timer("texture upload"):
+                    renderer.load_picture(picture, data)
+            return
+
+
+def is_resident(kind, picture):
+    if renderer is None:
+        return False
+    if kind == "tile":
+        return picture in renderer.atlas
+    return picture in renderer.textures
+
+
+def get_mosaic(picture):
+    mosaic = None if prefetcher is None else prefetcher.mosaic(picture)
+    if mosaic is None:
+        mosaic = mosaic_factory.cached_mosaic(picture, args.tiles, args.reuse)
+    return mosaic
+
+
+def create_renderer():
+    global renderer
+    renderer = Renderer(
+        mosaic_factory.ratio,
+        args.tiles,
+        args.tile_pixels,
+        len(mosaic_factory.images),
+        args.vram_budget * 2**20,
+        args.prefetch + 1,
     )
-    if reverse_sigmoid_progress > 0.1:
-        alpha = 1.0
-    else:
-        alpha = reverse_sigmoid_progress * 10.0
 
-    glClear(GL_COLOR_BUFFER_BIT)
-    glPushMatrix()
 
-    glTranslatef(center[0], center[1], 0.0)
-    glRotatef(angle, 0, 0, 1)
-    glTranslatef(-center[0], -center[1], 0.0)
+def hud_image():
+    p50, p99, maximum = instrumentation.percentiles("frame", HUD_FRAMES)
+    stats = renderer.stats
+    lines = [
+        "frame p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms ({:.0f} fps)".format(
+            p50 * 1000, p99 * 1000, maximum * 1000, 1 / p50 if p50 else 0
+        ),
+        "display {:.1f}ms spin {:.1f}ms swap {:.1f}ms (p50)".format(
+            *(
+                instrumentation.percentiles(name, HUD_FRAMES)[0] * 1000
+                for name in ("display", "spin", "swap")
+            )
+        ),
+        "mosaics {} hits {} misses, textures {} hits {} misses".format(
+            stats["mosaic hits"],
+            stats["mosaic misses"],
+            stats["texture hits"],
+            stats["texture misses"],
+        ),
+        "uploaded {} textures {} tiles {:.1f}MB".format(
+            stats["texture uploads"],
+            stats["tile uploads"],
+            stats["uploaded bytes"] / 2**20,
+        ),
+        "resident {:.1f}MB + {:.1f}MB atlas, budget {}MB".format(
+            renderer.resident_bytes / 2**20,
+            renderer.atlas_bytes / 2**20,
+            args.vram_budget,
+        ),
+    ]
+    text = "\n".join(lines)
+    font = ImageFont.load_default()
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font=font)
+    image = Image.new("RGB", (right + 8, bottom + 8))
+    ImageDraw.Draw(image).multiline_text((4, 4), text, font=font)
+    return image
+
+
+def draw_hud():
+    global hud_updated
+    if renderer is None:
+        return
+    now = time.perf_counter()
+    if renderer.overlay is None or now - hud_updated >= HUD_REFRESH:
+        hud_updated = now
+        renderer.load_overlay(hud_image())
+    renderer.draw_overlay(window_size[0], window_size[1], 0.75)
+
+
+def print_summary():
+    if renderer is not None:
+        print(
+            "GPU residency: "
+            + ", ".join(
+                "{} {}".format(value, key)
+                for key, value in sorted(renderer.stats.items())
+            )
+        )
+        for key, value in renderer.stats.items():
+            instrumentation.count(key, value)
+    memory_caches = dict(caches(mosaic_factory), tile_data=get_tile_data.cache)
+    for name, cache in sorted(memory_caches.items()):
+        stats = cache.stats()
+        if not stats["hits"] + stats["misses"]:
+            continue
+        print(
+            "{} cache: {} hits, {} misses, {} evictions".format(
+                name, stats["hits"], stats["misses"], stats["evictions"]
+            )
+        )
+        for key in ("hits", "misses", "evictions"):
+            instrumentation.count("{} cache {}".format(name, key), stats[key])
+    p50, p99, maximum = instrumentation.percentiles("frame")
+    print(
+        "frame times: p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            p50 * 1000, p99 * 1000, maximum * 1000
+        )
+    )
+    if args.trace is not None:
+        instrumentation.dump(args.trace)
+        print("trace written to {}".format(args.trace))
 
-    glTranslatef(start_point[0], start_point[1], 0.0)
-    glScalef(zoom, zoom, 1.0)
-    glTranslatef(-start_point[0], -start_point[1], 0.0)
 
-    glColor4f(0.0, 0.0, 0.0, alpha)
-    glCallList(mosaic_display_lists[current_mosaic_picture])
-    glColor4f(0.0, 0.0, 0.0, 1.0 - alpha)
+def display():
+    if current_mosaic_picture is None:
+        glClear(GL_COLOR_BUFFER_BIT)
+        return
+    max_zoom = args.tiles
+    zoom, alpha, transform = zoom_out(
+        progress,
+        mosaic_factory.ratio,
+        args.tiles,
+        start_picture_coord,
+        start_orientation,
+        current_mosaic_picture.orientation,
+    )
+    transform = projection @ transform
 
-    glScalef(max_zoom, max_zoom, 1.0)
-    glCallList(picture_display_lists[current_mosaic_picture])
+    # the zoomed in tile is promoted to its full resolution texture once it is
+    # displayed larger than in the atlas
+    promoted = zoom * size * window_size[1] / HEIGHT > renderer.tile_size[1]
 
-    glPopMatrix()
+    glClear(GL_COLOR_BUFFER_BIT)
+    renderer.begin_frame()
+    load_mosaic(current_mosaic_picture)
+    if alpha < 1.0:
+        load_picture(current_mosaic_picture)
+    if promoted:
+        load_picture(start_picture)
+
+    width = mosaic_factory.ratio * size
+    renderer.draw_mosaic(current_mosaic_picture, transform @ scaling(size), alpha)
+    if promoted:
+        renderer.draw_picture(
+            start_picture,
+            transform,
+            start_picture_coord[0] * width,
+            start_picture_coord[1] * size,
+            width,
+            size,
+            alpha,
+        )
+    if alpha < 1.0:
+        renderer.draw_picture(
+            current_mosaic_picture,
+            transform @ scaling(max_zoom),
+            0.0,
+            0.0,
+            width,
+            size,
+            1.0 - alpha,
+        )
 
 
 def spin_display():
     global progress
     global current_mosaic_picture
+    global start_picture
     global start_picture_coord
     global start_orientation
+    if current_mosaic_picture is None:
+        if walk.ready():
+            create_renderer()
+            start(walk.iterator())
+            reshape(*window_size)
+        return
     duration = args.duration
     old_progress = progress
     elapsed_time = sdl2.SDL_GetTicks() / 1000
     progress = (elapsed_time % duration) / duration
     if progress < old_progress:
-        current_tile_picture = current_mosaic_picture
+        start_picture = current_mosaic_picture
         start_orientation = current_mosaic_picture.orientation
         current_mosaic_picture = iterator.__next__()
+        prefetcher.advance()
         start_picture_coord = find_picture_in_mosaic(
-            current_tile_picture,
-            mosaic_factory.cached_mosaic(
-                current_mosaic_picture, args.tiles, args.reuse
-            ),
+            start_picture, get_mosaic(current_mosaic_picture)
         )
+    prefetch()
 
 
-def init():
-    width = mosaic_factory.ratio * size
-    height = size
-    print("loading textures:")
-    for i, img in enumerate(mosaic_factory.images.values()):
-        print(" {0}/{1}".format(i + 1, len(mosaic_factory.images)))
-        textures[img] = load_texture(img)
-        generate_picture_display_list(img, width, height)
-    print("generating mosaic display lists:")
+def start(images):
+    global iterator
+    global prefetcher
+    global current_mosaic_picture
+    global start_picture
+    global start_picture_coord
+    global start_orientation
+    iterator = Lookahead(images)
+    start_picture = iterator.__next__()
+    current_mosaic_picture = iterator.__next__()
+    start_orientation = start_picture.orientation
+    start_picture_coord = find_picture_in_mosaic(
+        start_picture, get_mosaic(current_mosaic_picture)
+    )
+    prefetcher = Prefetcher(
+        iterator,
+        args.prefetch,
+        get_mosaic,
+        get_tile_data,
+        get_picture_data,
+        is_resident,
+    )
+
+
+def compute_mosaics():
+    """Feeds the progressive walk with cached mosaics first, then with the ones
+    derived from a previous library. Prepares the thumbnails and then computes
+    the other mosaics one by one.
+    """
+    print("loading photos:")
+    mosaic_factory.load(args.folder, args.jobs, print_progress)
+    available = mosaic_factory.available_mosaics(args.tiles, args.reuse)
+    for img, mosaic in available.items():
+        walk.add_mosaic(img, mosaic)
+    if len(available) < len(mosaic_factory.images):
+        if mosaic_factory.update_mosaics(args.tiles, args.reuse) is not None:
+            for img, mosaic in mosaic_factory.available_mosaics(
+                args.tiles, args.reuse
+            ).items():
+                if img not in available:
+                    walk.add_mosaic(img, mosaic)
+                    available[img] = mosaic
+    prepare_thumbnails()
+    print("calculating mosaics:")
     for i, img in enumerate(mosaic_factory.images.values()):
-        print(" {0}/{1}".format(i + 1, len(mosaic_factory.images)))
-        generate_mosaic_display_list(img)
+        if img not in available:
+            walk.add_mosaic(img, get_mosaic(img))
+        print_progress("mosaics", i + 1, len(mosaic_factory.images))
+
+
+def init():
+    if not args.progressive:
+        create_renderer()
 
-    glEnable(GL_TEXTURE_2D)
     glEnable(GL_BLEND)
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
     glClearColor(0.0, 0.0, 0.0, 0.0)
-    glShadeModel(GL_FLAT)
 
 
 def reshape(w, h):
+    global window_size
+    global projection
+    window_size = (w, h)
     glViewport(0, 0, w, h)
-    ratio = float(w) / h
-    glMatrixMode(GL_PROJECTION)
-    glLoadIdentity()
-    viewport_center = HEIGHT * ratio / 2
-    photo_center = HEIGHT * mosaic_factory.ratio / 2
-    left = photo_center - viewport_center
-    right = photo_center + viewport_center
-    glOrtho(left, right, 0.0, HEIGHT, -1.0, 1.0)
-    glMatrixMode(GL_MODELVIEW)
-    glLoadIdentity()
+    if mosaic_factory.ratio is None:
+        return
+    projection = view_projection(w, h, mosaic_factory.ratio)
 
 
 def main():
@@ -313,39 +460,51 @@ def main():
     global size
     global args
     global progress
-    global textures
-    global picture_display_lists
-    global mosaic_display_lists
-    global start_picture_coord
-    global HEIGHT
-    global start_orientation
+    global renderer
+    global prefetcher
     global current_mosaic_picture
-    global iterator
+    global walk
+    global window_size
+    global hud_updated
 
     args = parser.parse_args()
+    if args.tour and args.progressive:
+        parser.error("--tour can't be used with --progressive")
 
     progress = 0.0
-    textures = {}
-    picture_display_lists = {}
-    mosaic_display_lists = {}
+    renderer = None
+    prefetcher = None
+    current_mosaic_picture = None
+    walk = None
+    window_size = (640, 480)
+    hud_updated = 0.0
 
-    mosaic_factory = MosaicFactory()
-    mosaic_factory.load(args.folder)
+    mosaic_factory = create_mosaic_factory(args)
 
-    HEIGHT = 100.0
     size = HEIGHT / args.tiles
 
-    iterator = image_iterator(mosaic_factory, args.tiles, args.reuse)
-    current_tile_picture = iterator.__next__()
-    current_mosaic_picture = iterator.__next__()
-    start_orientation = current_tile_picture.orientation
-
-    start_picture_coord = find_picture_in_mosaic(
-        current_tile_picture,
-        mosaic_factory.cached_mosaic(current_mosaic_picture, args.tiles, args.reuse),
-    )
+    if args.progressive:
+        walk = ProgressiveWalk()
+        threading.Thread(target=compute_mosaics, daemon=True).start()
+    else:
+        print("loading photos:")
+        mosaic_factory.load(args.folder, args.jobs, print_progress)
+        prepare_thumbnails()
+        if args.tour:
+            start(tour_iterator(mosaic_factory, args.tiles, args.reuse))
+        else:
+            start(image_iterator(mosaic_factory, args.tiles, args.reuse))
 
     sdl2.SDL_Init(sdl2.SDL_INIT_EVERYTHING)
+    # the shaders need OpenGL 3.3, macOS only gives it to core profiles
+    sdl2.SDL_GL_SetAttribute(sdl2.SDL_GL_CONTEXT_MAJOR_VERSION, 3)
+    sdl2.SDL_GL_SetAttribute(sdl2.SDL_GL_CONTEXT_MINOR_VERSION, 3)
+    sdl2.SDL_GL_SetAttribute(
+        sdl2.SDL_GL_CONTEXT_PROFILE_MASK, sdl2.SDL_GL_CONTEXT_PROFILE_CORE
+    )
+    sdl2.SDL_GL_SetAttribute(
+        sdl2.SDL_GL_CONTEXT_FLAGS, sdl2.SDL_GL_CONTEXT_FORWARD_COMPATIBLE_FLAG
+    )
     window = sdl2.SDL_CreateWindow(
         "Mosaic for {}".format(args.folder).encode("utf8"),
         sdl2.SDL_WINDOWPOS_CENTERED,
@@ -357,24 +516,36 @@ def main():
     if not window:
         sys.stderr.write("Error: Could not create window\n")
         exit(1)
-    sdl2.SDL_GL_CreateContext(window)
+    context = sdl2.SDL_GL_CreateContext(window)
     init()
     reshape(640, 480)
 
     event = sdl2.SDL_Event()
     running = True
     while running:
-        while sdl2.SDL_PollEvent(ctypes.byref(event)) != 0:
-            if event.type == sdl2.SDL_QUIT:
-                running = False
-            if (
-                event.type == sdl2.events.SDL_WINDOWEVENT
-                and event.window.event == sdl2.SDL_WINDOWEVENT_RESIZED
-            ):
-                reshape(event.window.data1, event.window.data2)
-        display()
-        spin_display()
-        sdl2.SDL_GL_SwapWindow(window)
+        with instrumentation.timer("frame"):
+            while sdl2.SDL_PollEvent(ctypes.byref(event)) != 0:
+                if event.type == sdl2.SDL_QUIT:
+                    running = False
+                if (
+                    event.type == sdl2.events.SDL_WINDOWEVENT
+                    and event.window.event == sdl2.SDL_WINDOWEVENT_RESIZED
+                ):
+                    reshape(event.window.data1, event.window.data2)
+            with instrumentation.timer("display"):
+                display()
+            with instrumentation.timer("spin"):
+                spin_display()
+            if args.hud:
+                draw_hud()
+            with instrumentation.timer("swap"):
+                sdl2.SDL_GL_SwapWindow(window)
+    if prefetcher is not None:
+        prefetcher.close()
+    print_summary()
+    sdl2.SDL_GL_DeleteContext(context)
+    sdl2.SDL_DestroyWindow(window)
+    sdl2.SDL_Quit()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+import struct
+from os import makedirs, path, replace
+
+import numpy as np
+
+MAGIC = b"MOSAICS\x01"
+# magic, images count, tiles per side, tiles item size
+HEADER = struct.Struct("<8sIII")
+HASH_SIZE = 16
+
+
+def tiles_dtype(count):
+    return np.dtype("<u2") if count <= 2**16 else np.dtype("<u4")
+
+
+class MosaicArray(object):
+    """Mosaics of the images of a library packed in a memory-mapped file: a header,
+    the table of the images hashes, one byte per image telling whether its mosaic
+    is computed and then the nb_segments×nb_segments arrays of the positions of
+    the tiles of each mosaic in that table, lines from the top.
+    Reading a mosaic doesn't copy it. A mosaic is flagged as computed once its
+    tiles are written.
+    """
+
+    def __init__(self, fpath, hashes, nb_segments):
+        self.fpath = fpath
+        self.hashes = list(hashes)
+        self.positions = {h: i for i, h in enumerate(self.hashes)}
+        self.nb_segments = nb_segments
+        count = len(self.hashes)
+        dtype = tiles_dtype(count)
+        table_offset = HEADER.size
+        flags_offset = table_offset + count * HASH_SIZE
+        # aligned tiles arrays
+        tiles_offset = -(-(flags_offset + count) // 8) * 8
+        size = tiles_offset + count * nb_segments**2 * dtype.itemsize
+        if not self.valid(size):
+            self.create(size)
+        self.flags = np.memmap(fpath, np.uint8, "r+", flags_offset, (count,))
+        self.tiles = np.memmap(
+            fpath, dtype, "r+", tiles_offset, (count, nb_segments, nb_segments)
+        )
+
+    def valid(self, size):
+        try:
+            with open(self.fpath, "rb") as f:
+                header = HEADER.unpack(f.read(HEADER.size))
+                table = f.read(len(self.hashes) * HASH_SIZE)
+        except (IOError, struct.error):
+            return False
+        return (
+            header
+            == (
+                MAGIC,
+                len(self.hashes),
+                self.nb_segments,
+                tiles_dtype(len(self.hashes)).itemsize,
+            )
+            and table == b"".join(map(bytes.fromhex, self.hashes))
+            and path.getsize(self.fpath) == size
+        )
+
+    def create(self, size):
+        """Creates an empty file, tiles and flags are sparse zeros"""
+        makedirs(path.dirname(self.fpath), exist_ok=True)
+        tmp_path = self.fpath + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    len(self.hashes),
+                    self.nb_segments,
+                    tiles_dtype(len(self.hashes)).itemsize,
+                )
+            )
+            f.write(b"".join(map(bytes.fromhex, self.hashes)))
+            f.truncate(size)
+        replace(tmp_path, self.fpath)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, position):
+        return bool(self.flags[position])
+
+    def __getitem__(self, position):
+        return self.tiles[position] if self.flags[position] else None
+
+    def __setitem__(self, position, tiles):
+        self.tiles[position] = tiles
+        self.flags[position] = 1
+
+    def computed(self):
+        """Positions of the images whose mosaic is computed"""
+        return np.flatnonzero(self.flags)
+
+    def complete(self):
+        return bool(self.flags.all())
+
+    def flush(self):
+        self.tiles.flush()
+        self.flags.flush()
@@ -1,68 +1,297 @@
-import hashlib
-import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 from itertools import groupby
-from os import listdir, makedirs, path
+from os import listdir, path, stat
 
+import numpy as np
 from PIL import Image
 
-from cache import CACHE_DIR
-from memoized import memoized
-from mosaicimage import MosaicImage
+from colorindex import ColorCubeIndex, FeatureIndex, LinearIndex
+from features import METRICS, grid_features
+from instrumentation import timed
+from memoized import caches, memoized
+from mosaicimage import (
+    MosaicImage,
+    analyze_image,
+    calculate_features,
+    hash_file,
+    resize,
+)
+from store import Store, library_hash
+from thumbnails import Thumbnails
+
+
+def print_nothing(*args):
+    pass
+
+
+def print_progress(stage, done, total):
+    print(" {0} {1}/{2}".format(stage, done, total))
+
+
+INDEXES = {index.name: index for index in (LinearIndex, ColorCubeIndex)}
+# number of mosaics written to a MosaicArray between two flushes
+MOSAICS_BATCH_SIZE = 100
+# number of mosaics, as lists of images, kept in memory
+MOSAICS_CACHE_SIZE = 64
+# bytes of cells descriptors kept in memory
+FEATURES_CACHE_BYTES = 64 * 2**20
+
+
+def cell_edges(size, nb_segments):
+    """Bounds of nb_segments cells sharing size pixels, their sizes differ by one
+    pixel at most
+    """
+    return [size * i // nb_segments for i in range(nb_segments + 1)]
+
+
+def resized_tiles(img, sizes):
+    """dict of each (width, height) of sizes to the RGB array of img resized to
+    it, img is decoded once
+    """
+    width = max(w for w, _ in sizes)
+    height = max(h for _, h in sizes)
+    with img.open_image(width, height) as image:
+        return {size: np.asarray(resize(image, *size, img.draft)) for size in sizes}
+
+
+def mosaic_strips(mosaic, width, height):
+    """Renders a width×height mosaic one line of tiles at a time: yields the RGB
+    array of each line, from the top. Each distinct tile is decoded once, resized
+    to the sizes of the cells it fills and forgotten after the last line using it.
+    """
+    xs = cell_edges(width, len(mosaic))
+    ys = cell_edges(height, len(mosaic))
+    sizes = {}
+    last_line = {}
+    for i, line in enumerate(mosaic):
+        for j, img in enumerate(line):
+            size = (xs[j + 1] - xs[j], ys[i + 1] - ys[i])
+            sizes.setdefault(img, set()).add(size)
+            last_line[img] = i
+    tiles = {}
+    for i, line in enumerate(mosaic):
+        strip = np.empty((ys[i + 1] - ys[i], width, 3), dtype=np.uint8)
+        for j, img in enumerate(line):
+            if img not in tiles:
+                tiles[img] = resized_tiles(img, sizes[img])
+            left, right = xs[j], xs[j + 1]
+            strip[:, left:right] = tiles[img][(right - left, len(strip))]
+        for img in set(line):
+            if last_line[img] == i:
+                del tiles[img]
+        yield strip
+
+
+def create_thumbnail(img, width, height):
+    # the image itself isn't sent back to the parent process
+    img.create_resized(width, height)
+
+
+def parallel_map(executor, func, args, progress=None):
+    """Like executor.map(func, *zip(*args)) but results are reported to
+    progress(done, total) as soon as they are ready.
+    """
+    res = [None] * len(args)
+    futures = {executor.submit(func, *arg): i for i, arg in enumerate(args)}
+    for done, future in enumerate(as_completed(futures)):
+        res[futures[future]] = future.result()
+        if progress is not None:
+            progress(done + 1, len(args))
+    return res
 
 
 class MosaicFactory(object):
-    def __init__(self):
+    def __init__(
+        self,
+        index="cube",
+        assignment="greedy",
+        draft=True,
+        hash_algorithm="md5",
+        store=None,
+        metric="rgb",
+        thumbnails=None,
+    ):
         self.ratio = None
         self.images = {}
+        self.image_list = []
+        self.positions = {}
+        self.arrays = {}
+        self.folder = None
+        self.store = Store() if store is None else store
+        self.thumbnails = Thumbnails() if thumbnails is None else thumbnails
+        self.draft = draft
+        self.hash_algorithm = hash_algorithm
+        self.assignment = assignment
+        self.metric = metric
+        # side of the sub-grid describing each cell, None for average RGB colors
+        self.cells = METRICS[metric]
+        self.index_class = INDEXES[index] if self.cells is None else FeatureIndex
+        self.index = self.index_class([])
 
     def hash(self):
-        return hashlib.md5(
-            "".join(sorted([img.hash for img in self.images.values()])).encode("utf8")
-        ).hexdigest()
+        return library_hash(self.images)
 
-    @staticmethod
-    def color_difference(clr1, clr2):
-        return sum(map(lambda c: abs(c[0] - c[1]), zip(clr1, clr2)))
+    def mode(self, reuse=True):
+        res = str(reuse)
+        if not reuse and self.assignment != "greedy":
+            res = self.assignment
+        if self.metric != "rgb":
+            res = "{}-{}".format(res, self.metric)
+        return res
 
-    @staticmethod
-    def find_nearest_image(color, images):
-        nearest = None
-        nearest_delta = 1000
-        for img in images:
-            delta = MosaicFactory.color_difference(color, img.average_color)
-            if delta < nearest_delta:
-                nearest_delta = delta
-                nearest = img
-        return nearest
+    def mosaic_array(self, nb_segments, reuse=True):
+        """MosaicArray of this library, in the order of self.images"""
+        key = (nb_segments, self.mode(reuse))
+        if key not in self.arrays:
+            self.arrays[key] = self.store.mosaic_array(
+                self.hash(), nb_segments, self.mode(reuse), list(self.images)
+            )
+        return self.arrays[key]
 
+    def tiles_images(self, tiles):
+        return [[self.image_list[i] for i in line] for line in tiles.tolist()]
+
+    @memoized(max_size=MOSAICS_CACHE_SIZE, thread_safe=True)
     def cached_mosaic(self, img, nb_segments, reuse=True):
-        dir = path.join(CACHE_DIR, "mosaics", self.hash(), str(nb_segments), str(reuse))
-        fpath = path.join(dir, "{}.json".format(img.hash))
-        try:
-            with open(fpath, "r") as f:
-                data = json.load(f)
-                return [[self.images[hash] for hash in line] for line in data]
-        except (IOError, json.JSONDecodeError):
-            m = self.mosaic(img, nb_segments, reuse)
-            data = [[img.hash for img in line] for line in m]
-            makedirs(dir, exist_ok=True)
-            with open(fpath, "w") as f:
-                json.dump(data, f)
-            return m
-
-    @memoized
-    def mosaic(self, img, nb_segments, reuse=True):
-        available_images = list(self.images.values())[:]  # TODO: unneded copy
-        pixels = img.get_grid(nb_segments)
-        res = []
-        for line in pixels:
-            res.append([])
-            for pixel in line:
-                nearest = MosaicFactory.find_nearest_image(pixel, available_images)
-                res[-1].append(nearest)
-                if not reuse:
-                    available_images.remove(nearest)
-        return res
+        array = self.mosaic_array(nb_segments, reuse)
+        position = self.positions[img.hash]
+        tiles = array[position]
+        if tiles is None:
+            tiles = self.nearest_tiles(img, nb_segments, reuse)
+            array[position] = tiles
+            array.flush()
+        return self.tiles_images(tiles)
+
+    def available_mosaics(self, nb_segments, reuse=True):
+        """Mosaics of images that are already cached, without computing any."""
+        array = self.mosaic_array(nb_segments, reuse)
+        return {
+            self.image_list[i]: self.tiles_images(array[i]) for i in array.computed()
+        }
+
+    def all_mosaics(self, nb_segments, reuse=True, progress=None):
+        """MosaicArray holding the mosaics of all images: missing ones are derived
+        from a previous library if possible or computed, and flushed in batches.
+        """
+        array = self.mosaic_array(nb_segments, reuse)
+        previous = None
+        if not array.complete():
+            previous = self.update_mosaics(nb_segments, reuse, progress)
+        if previous is not None:
+            # the mosaics missing from the previous library were computed too
+            return array
+        computed = 0
+        for i, img in enumerate(self.image_list):
+            if i not in array:
+                array[i] = self.nearest_tiles(img, nb_segments, reuse)
+                computed += 1
+                if computed % MOSAICS_BATCH_SIZE == 0:
+                    array.flush()
+            if progress is not None:
+                progress(i + 1, len(self.images))
+        array.flush()
+        return array
+
+    @timed("update mosaics")
+    def update_mosaics(self, nb_segments, reuse=True, progress=None):
+        """Derives the missing mosaics of this library from the ones of the
+        previous library of the same folder, and computes the ones of the images
+        it didn't have. Returns that library hash, or None if there is none.
+        """
+        mode = self.mode(reuse)
+        previous = self.store.previous_library(
+            self.folder, self.hash(), nb_segments, mode
+        )
+        if previous is None:
+            return None
+        previous_hashes = sorted(self.store.library_images(previous))
+        previous_array = self.store.mosaic_array(
+            previous, nb_segments, mode, previous_hashes
+        )
+        # positions in this library of the previous images, -1 for removed ones
+        moved = np.array(
+            [self.positions.get(h, -1) for h in previous_hashes], dtype=np.intp
+        )
+        added = np.array(
+            [i for i, h in enumerate(self.images) if h not in previous_array.positions],
+            dtype=np.intp,
+        )
+        array = self.mosaic_array(nb_segments, reuse)
+        for i, img in enumerate(self.image_list):
+            previous_tiles = None
+            if img.hash in previous_array.positions:
+                previous_tiles = previous_array[previous_array.positions[img.hash]]
+            if i in array:
+                pass
+            elif previous_tiles is None:
+                array[i] = self.nearest_tiles(img, nb_segments, reuse)
+            else:
+                tiles = moved[previous_tiles]
+                m = self.updated_mosaic(img, tiles, added, nb_segments, reuse)
+                array[i] = tiles if m is None else m
+            if (i + 1) % MOSAICS_BATCH_SIZE == 0:
+                array.flush()
+            if progress is not None:
+                progress(i + 1, len(self.images))
+        array.flush()
+        return previous
+
+    def updated_mosaic(self, img, tiles, added, nb_segments, reuse):
+        """Mosaic of img given the positions of its mosaic tiles in a previous
+        library translated to this library, -1 for removed tiles, or None if it
+        did not change. Only cells which used a removed tile or for which an added
+        tile is nearer are updated when tiles can be reused, otherwise the mosaic
+        is recomputed as soon as one cell changes. An added tile can change an
+        optimal assignment without being nearer to any cell, so these are always
+        recomputed when tiles were added.
+        """
+        pixels = self.cells_features(img, nb_segments)
+        nearest = tiles.reshape(-1).copy()
+        gone = nearest < 0
+        if not reuse and (gone.any() or (len(added) and self.assignment == "optimal")):
+            return self.nearest_tiles(img, nb_segments, reuse)
+        if gone.any():
+            nearest[gone] = self.index.nearest(pixels[gone])
+        better = np.zeros(len(nearest), dtype=bool)
+        if len(added):
+            distances = self.index.pair_distances(pixels, self.index.colors[nearest])
+            candidates = added[self.index.subset(added).nearest(pixels)]
+            candidates_distances = self.index.pair_distances(
+                pixels, self.index.colors[candidates]
+            )
+            # same tie breaking as a full search: the lowest index wins
+            better = (candidates_distances < distances) | (
+                (candidates_distances == distances) & (candidates < nearest)
+            )
+            if better.any() and not reuse:
+                return self.nearest_tiles(img, nb_segments, reuse)
+            nearest[better] = candidates[better]
+        if not gone.any() and not better.any():
+            return None
+        return nearest.reshape(nb_segments, nb_segments)
+
+    @memoized(
+        max_bytes=FEATURES_CACHE_BYTES, sizeof=lambda a: a.nbytes, thread_safe=True
+    )
+    def cells_features(self, img, nb_segments):
+        """Descriptors of the nb_segments² cells of img, lines from the top, to be
+        compared with the ones of the tiles in self.index
+        """
+        if self.cells is None:
+            return img.get_grid(nb_segments).reshape(-1, 3)
+        return grid_features(img.get_grid(nb_segments * self.cells), self.cells)
+
+    def nearest_tiles(self, img, nb_segments, reuse=True):
+        """Positions in self.images of the tiles of the mosaic of img"""
+        pixels = self.cells_features(img, nb_segments)
+        if reuse:
+            nearest = self.index.nearest(pixels)
+        elif self.assignment == "optimal":
+            nearest = self.index.optimal_without_reuse(pixels)
+        else:
+            nearest = self.index.nearest_without_reuse(pixels)
+        return nearest.reshape(nb_segments, nb_segments)
 
     @staticmethod
     def list_image_files(folder):
@@ -74,15 +303,56 @@ class MosaicFactory(object):
             or name.lower().endswith(".png")
         ]
 
-    def load(self, folder):
-        filenames = MosaicFactory.list_image_files(folder)
-        print("calculating average colors:")
-        all_images = []
-        for i, filename in enumerate(filenames):
-            print(" {0}/{1}".format(i + 1, len(filenames)))
-            image_path = path.join(folder, filename)
-            img = MosaicImage(image_path)
-            all_images.append(img)
+    @timed("load photos")
+    def load(self, folder, workers=None, progress=None):
+        """Hashes new or modified files then analyzes unknown images, and describes
+        them for the metric, in worker processes. progress(stage, done, total) is
+        called each time a file is processed.
+        """
+        self.folder = path.abspath(folder)
+        paths = [
+            path.join(self.folder, filename)
+            for filename in MosaicFactory.list_image_files(folder)
+        ]
+        if progress is None:
+            progress = print_nothing
+        # files with the same path, size, mtime and inode keep their hash
+        fingerprints = self.store.fingerprints(self.hash_algorithm)
+        stats = []
+        for image_path in paths:
+            st = stat(image_path)
+            stats.append((st.st_size, st.st_mtime_ns, st.st_ino))
+        stale = [
+            i
+            for i, image_path in enumerate(paths)
+            if fingerprints.get(image_path, (None,))[0] != stats[i]
+        ]
+        with ProcessPoolExecutor(workers) as executor:
+            computed = parallel_map(
+                executor,
+                hash_file,
+                [(paths[i], self.hash_algorithm) for i in stale],
+                partial(progress, "hashing"),
+            )
+            computed = {paths[i]: (stats[i], h) for i, h in zip(stale, computed)}
+            self.store.add_fingerprints(self.hash_algorithm, computed)
+            fingerprints.update(computed)
+            hashes = [fingerprints[image_path][1] for image_path in paths]
+            images_data = self.store.images()
+            unknown = {h: p for p, h in zip(paths, hashes) if h not in images_data}
+            analyzed = parallel_map(
+                executor,
+                analyze_image,
+                [(image_path, self.draft) for image_path in unknown.values()],
+                partial(progress, "analyzing"),
+            )
+        analyzed = dict(zip(unknown, analyzed))
+        self.store.add_images(analyzed)
+        images_data.update(analyzed)
+        all_images = [
+            MosaicImage(image_path, h, images_data[h], self.draft, self.thumbnails)
+            for image_path, h in zip(paths, hashes)
+        ]
 
         # group images by ratio
         def get_ratio(img):
@@ -94,29 +364,70 @@ class MosaicFactory(object):
             image_groups.append(list(images))
         # take only the largest group
         image_groups.sort(key=len, reverse=True)
-        self.images = {image.hash: image for image in image_groups[0]}
+        # mosaic arrays refer to images by their position in the sorted hashes
+        self.images = {
+            image.hash: image
+            for image in sorted(image_groups[0], key=lambda img: img.hash)
+        }
+        self.image_list = list(self.images.values())
+        self.positions = {h: i for i, h in enumerate(self.images)}
+        self.arrays = {}
+        for cache in caches(self).values():
+            cache.clear()
         self.ratio = image_groups[0][0].ratio
+        if self.cells is None:
+            colors = [img.average_color for img in self.images.values()]
+        else:
+            colors = self.load_features(workers, progress)
+        self.index = self.index_class.cached(
+            colors,
+            path.join(
+                self.store.mosaics_dir(self.hash()),
+                "{}.npz".format(
+                    self.index_class.name if self.cells is None else self.metric
+                ),
+            ),
+        )
+        self.store.add_library(self.hash(), self.folder, list(self.images))
 
-    @staticmethod
-    def render_mosaic(mosaic, width, height):
-        nb_segments = len(mosaic)
-        pane_width = width / nb_segments
-        pane_height = height / nb_segments
-        res = Image.new("RGB", (width, height), (0, 0, 0))
-        for i, line in enumerate(mosaic):
-            for j, img in enumerate(line):
-                with img.resized(pane_width, pane_height) as image:
-                    res.paste(image, (j * pane_width, i * pane_height))
-                print("%3d/%3d" % (i * nb_segments + j, nb_segments**2))
-        return res
-
+    def load_features(self, workers=None, progress=print_nothing):
+        """Descriptors of the tiles for self.metric, in the order of self.images:
+        the ones missing from the store are computed in worker processes
+        """
+        features = self.store.features(self.metric)
+        missing = [img for img in self.image_list if img.hash not in features]
+        if missing:
+            with ProcessPoolExecutor(workers) as executor:
+                computed = parallel_map(
+                    executor,
+                    calculate_features,
+                    [(img.path, self.cells, self.draft) for img in missing],
+                    partial(progress, "describing"),
+                )
+            computed = {img.hash: f for img, f in zip(missing, computed)}
+            self.store.add_features(self.metric, computed)
+            features.update(computed)
+        return np.stack([features[h] for h in self.images])
 
-# TODO: remove main
-if __name__ == "__main__":
-    from sys import argv
-
-    folder = argv[1]
-    factory = MosaicFactory.load(folder)
+    @timed("prepare thumbnails")
+    def prepare_thumbnails(self, width, height, workers=None, progress=None):
+        """Creates the missing width×height thumbnails in worker processes"""
+        missing = [
+            img
+            for img in self.images.values()
+            if not path.exists(img.resized_path(width, height))
+        ]
+        with ProcessPoolExecutor(workers) as executor:
+            parallel_map(
+                executor,
+                create_thumbnail,
+                [(img, width, height) for img in missing],
+                progress,
+            )
 
-#    mosaic = factory.cached_mosaic(m.images[0], 40)
-#    img = MosaicFactory.render_mosaic(mosaic, 1024, 768)
+    @staticmethod
+    def render_mosaic(mosaic, width, height):
+        """width×height PIL image of a mosaic, see export.py for large ones"""
+        return Image.fromarray(
+            np.concatenate(list(mosaic_strips(mosaic, width, height)))
+        )
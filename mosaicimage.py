@@ -1,101 +1,162 @@
 import hashlib
-import json
 from contextlib import contextmanager
-from os import makedirs, path
 
+import numpy as np
 from PIL import Image
 
-from cache import CACHE_DIR
+from features import srgb_to_lab
+from thumbnails import Thumbnails
 
+HASH_CHUNK_SIZE = 1024 * 1024
 
-def hash_file(fpath):
+
+def new_hash(algorithm):
+    # all algorithms give 32 hexadecimal digits
+    if algorithm == "xxh128":
+        import xxhash
+
+        return xxhash.xxh3_128()
+    elif algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.md5()
+
+
+def hash_file(fpath, algorithm="md5"):
+    res = new_hash(algorithm)
     with open(fpath, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            res.update(chunk)
+    return res.hexdigest()
 
 
 def calculate_ratio(image):
     return image.size[0] / float(image.size[1])
 
 
-def calculate_average_color(image):
-    return image.resize((1, 1), Image.Resampling.LANCZOS).getpixel((0, 0))
+def calculate_average_color(image, reduce=True):
+    return resize(image, 1, 1, reduce).getpixel((0, 0))
 
 
 def calculate_orientation(image):
     orientations = {1: 0, 3: 180, 6: 270, 8: 90}
     try:
         exif_orientation = image._getexif().get(274)
-    except KeyError:
+    except (AttributeError, KeyError):
         exif_orientation = 1
     return orientations.get(exif_orientation, 0)
 
 
+def resize(image, width, height, reduce=True):
+    # reduce() by an integer factor first, then LANCZOS on the remaining 3x
+    return image.resize(
+        (width, height), Image.Resampling.LANCZOS, reducing_gap=3.0 if reduce else None
+    )
+
+
+@contextmanager
+def decode(image_path, size=None):
+    """Opens an RGB image, at a reduced resolution still covering size when the
+    format supports it (JPEG DCT scaling decodes 1/2, 1/4 or 1/8 of the pixels).
+    """
+    with Image.open(image_path) as image:
+        if size is not None:
+            image.draft("RGB", size)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        yield image
+
+
+def decoding_error(image_path, width, height):
+    """Largest channel difference between the reduced and full decodings of an
+    image, both resized to width×height.
+    """
+    with decode(image_path, (width, height)) as image:
+        reduced = np.asarray(resize(image, width, height), dtype=np.int32)
+    with decode(image_path) as image:
+        full = np.asarray(resize(image, width, height, False), dtype=np.int32)
+    return int(np.abs(reduced - full).max())
+
+
+def analyze_image(image_path, draft=True):
+    with Image.open(image_path) as image:
+        width, height = image.size
+        ratio = calculate_ratio(image)
+        orientation = calculate_orientation(image)
+    with decode(image_path, (1, 1) if draft else None) as image:
+        average_color = calculate_average_color(image, draft)
+    return {
+        "average_color": average_color,
+        "ratio": ratio,
+        "orientation": orientation,
+        "width": width,
+        "height": height,
+    }
+
+
+def calculate_features(image_path, cells, draft=True):
+    """CIELAB colors of the cells×cells grid of an image, lines from the top"""
+    with decode(image_path, (cells, cells) if draft else None) as image:
+        grid = np.asarray(resize(image, cells, cells, draft))
+    return srgb_to_lab(grid).reshape(-1)
+
+
 class MosaicImage(object):
-    def __init__(self, image_path):
+    def __init__(self, image_path, hash, data, draft=True, thumbnails=None):
         self.path = image_path
-        self.hash = hash_file(self.path)
-        thumbnails_dir = path.join(CACHE_DIR, "images", self.hash)
-        fpath = path.join(thumbnails_dir, "data.json")
-        try:
-            with open(fpath, "r") as f:
-                data = json.load(f)
-                self.average_color = data["average_color"]
-                self.ratio = data["ratio"]
-                self.orientation = data["orientation"]
-                self.width = data["width"]
-                self.height = data["height"]
-        except (IOError, json.JSONDecodeError):
-            with self.open_image() as image:
-                self.average_color = calculate_average_color(image)
-                self.ratio = calculate_ratio(image)
-                self.orientation = calculate_orientation(image)
-                width, height = image.size
-                self.width = width
-                self.height = height
-            makedirs(thumbnails_dir, exist_ok=True)
-            with open(fpath, "w") as f:
-                json.dump(
-                    {
-                        "average_color": self.average_color,
-                        "ratio": self.ratio,
-                        "orientation": self.orientation,
-                        "width": self.width,
-                        "height": self.height,
-                    },
-                    f,
-                    indent=4,
-                )
+        self.hash = hash
+        self.draft = draft
+        self.thumbnails = Thumbnails() if thumbnails is None else thumbnails
+        self.average_color = tuple(data["average_color"])
+        self.ratio = data["ratio"]
+        self.orientation = data["orientation"]
+        self.width = data["width"]
+        self.height = data["height"]
 
     def __lt__(self, other):
         return self.path < other.path
 
     @contextmanager
-    def open_image(self):
-        with Image.open(self.path) as image:
-            if image.mode != "RGB":
-                image = image.convert("RGB")
+    def open_image(self, width=None, height=None):
+        size = (width, height) if self.draft and width is not None else None
+        with decode(self.path, size) as image:
             yield image
 
+    def resized_path(self, width, height, lossless=False):
+        return self.thumbnails.path(self.hash, width, height, lossless)
+
+    def create_resized(self, width, height, lossless=False):
+        """Writes the width×height thumbnail, returns it"""
+        with self.open_image(width, height) as image:
+            resized = resize(image, width, height, self.draft)
+        self.thumbnails.save(resized, self.resized_path(width, height, lossless))
+        return resized
+
     @contextmanager
-    def resized(self, width, height):
-        thumbnails_dir = path.join(CACHE_DIR, "images", self.hash)
-        makedirs(thumbnails_dir, exist_ok=True)
-        fpath = path.join(thumbnails_dir, "{}x{}".format(width, height))
+    def resized(self, width, height, lossless=False):
+        fpath = self.resized_path(width, height, lossless)
         try:
             with Image.open(fpath) as image:
+                self.thumbnails.touch(fpath)
                 yield image
         except FileNotFoundError:
-            with self.open_image() as image:
-                resized = image.resize((width, height), Image.Resampling.LANCZOS)
-                resized.save(fpath, "PNG")  # TODO: use jpeg for large images
-                yield resized
+            yield self.create_resized(width, height, lossless)
 
     def get_grid(self, nb_segments):
-        with self.resized(nb_segments, nb_segments) as small:
-            data = small.getdata()
-        res = []
-        for i in range(nb_segments):
-            res.append([])
-            for j in range(nb_segments):
-                res[-1].append(data[i * nb_segments + j])
-        return res
+        # colors of the cells have to be exact for mosaics to be reproducible
+        with self.resized(nb_segments, nb_segments, lossless=True) as small:
+            return np.asarray(small.convert("RGB"), dtype=np.int32)
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    # compares reduced and full decodings: mosaicimage.py TILES IMAGE...
+    nb_segments = int(argv[1])
+    for image_path in argv[2:]:
+        print(
+            "{}: average color {}, grid {}".format(
+                image_path,
+                decoding_error(image_path, 1, 1),
+                decoding_error(image_path, nb_segments, nb_segments),
+            )
+        )
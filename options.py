@@ -0,0 +1,119 @@
+"""Command line options shared by the viewer, export.py and video.py, added to
+their parsers with parents=[...]
+"""
+
+import argparse
+
+from features import METRICS
+from mosaicfactory import INDEXES, MosaicFactory
+from thumbnails import FORMATS, Thumbnails
+
+library_options = argparse.ArgumentParser(add_help=False)
+library_options.add_argument("folder", type=str, help="folder containing photos")
+library_options.add_argument(
+    "-t", "--tiles", type=int, default=40, help="number of tiles in each mosaic"
+)
+library_options.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="number of worker processes (defaults to the number of CPUs)",
+)
+library_options.add_argument(
+    "--full-decode",
+    dest="draft",
+    action="store_false",
+    help="decode photos at full resolution before shrinking them instead of"
+    " letting JPEG decoding skip unneeded detail. The colors, descriptors and"
+    " thumbnails already cached aren't keyed by it and keep the decoding they were"
+    " computed with, it only applies to the photos that aren't cached yet",
+)
+library_options.add_argument(
+    "--hash",
+    choices=["md5", "blake2b", "xxh128"],
+    default="md5",
+    help="algorithm identifying photos by their content, changing it makes cached"
+    " data unreachable (defaults to md5, xxh128 requires xxhash)",
+)
+library_options.add_argument(
+    "-i",
+    "--index",
+    choices=sorted(INDEXES),
+    default="cube",
+    help="color index used to find the nearest tiles (defaults to cube)",
+)
+library_options.add_argument(
+    "-m",
+    "--metric",
+    choices=list(METRICS),
+    default="rgb",
+    help="how cells and tiles are compared: rgb compares average colors, lab"
+    " compares them in the CIELAB color space, lab2x2 and lab3x3 compare the CIELAB"
+    " colors of a sub-grid of each cell and look as good with fewer tiles. Metrics"
+    " other than rgb ignore --index (defaults to rgb)",
+)
+library_options.add_argument(
+    "-n",
+    "--no-reuse",
+    dest="reuse",
+    action="store_false",
+    help="a tile can only be used once in a photo (this requires that tiles²"
+    " <= #photos in folder)",
+)
+library_options.add_argument(
+    "-a",
+    "--assignment",
+    choices=["greedy", "optimal"],
+    default="greedy",
+    help="how tiles are placed when they can't be reused: greedy takes the nearest"
+    " available tile for each cell in order, optimal minimizes the total color"
+    " difference (requires scipy)",
+)
+
+thumbnails_options = argparse.ArgumentParser(add_help=False)
+thumbnails_options.add_argument(
+    "--thumbnails",
+    choices=list(FORMATS),
+    default="jpeg",
+    help="format of the cached thumbnails of the photos (defaults to jpeg)",
+)
+thumbnails_options.add_argument(
+    "--thumbnails-quality",
+    type=int,
+    default=90,
+    help="quality of jpeg and webp thumbnails, from 0 to 100 (defaults to 90)",
+)
+thumbnails_options.add_argument(
+    "--thumbnails-budget",
+    type=int,
+    default=1024,
+    help="megabytes of cached thumbnails, the least recently used ones are removed"
+    " beyond it (defaults to 1024)",
+)
+
+walk_options = argparse.ArgumentParser(add_help=False)
+walk_options.add_argument(
+    "--tour",
+    action="store_true",
+    help="show the photos along a tour planned once and cached, which goes through"
+    " each photo about once before starting over, instead of choosing each step"
+    " at runtime",
+)
+
+
+def create_mosaic_factory(args):
+    """MosaicFactory configured by the library and thumbnails options of args"""
+    thumbnails = None
+    if "thumbnails" in args:
+        thumbnails = Thumbnails(
+            args.thumbnails, args.thumbnails_quality, args.thumbnails_budget * 2**20
+        )
+    return MosaicFactory(
+        args.index,
+        args.assignment,
+        args.draft,
+        args.hash,
+        metric=args.metric,
+        thumbnails=thumbnails,
+    )
@@ -0,0 +1,152 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# tiles decoded together by the worker threads
+TILES_BATCH_SIZE = 64
+
+
+class Prefetcher(object):
+    """Prepares in background threads what the next steps of a walk need: their
+    mosaics and the decoded pixels of their tiles and photos. The GL thread only
+    has to upload them, see take_tile() and take_texture().
+    walk is a graph.Lookahead, get_mosaic(picture), get_tile_data(picture) and
+    get_picture_data(picture) prepare the data, resident(kind, picture) tells
+    whether the "tile" or the "texture" of a picture is already uploaded.
+    At most max_tiles decoded tiles wait for their upload. close() stops the
+    background threads.
+    """
+
+    def __init__(
+        self,
+        walk,
+        steps,
+        get_mosaic,
+        get_tile_data,
+        get_picture_data,
+        resident,
+        workers=None,
+        max_tiles=4096,
+    ):
+        self.walk = walk
+        self.steps = steps
+        self.get_mosaic = get_mosaic
+        self.get_tile_data = get_tile_data
+        self.get_picture_data = get_picture_data
+        self.resident = resident
+        self.max_tiles = max_tiles
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.stopped = False
+        self.pictures = []
+        self.mosaics = {}
+        self.tiles = {}
+        self.textures = {}
+        self.executor = ThreadPoolExecutor(workers)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def advance(self):
+        """Tells that the walk took a step"""
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def close(self):
+        """Stops preparing data, once the current batch of tiles is decoded"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.executor.shutdown(cancel_futures=True)
+
+    def upcoming(self):
+        """Next pictures of the walk, as long as their mosaic is ready"""
+        with self.condition:
+            res = []
+            for picture in self.pictures:
+                if picture not in self.mosaics:
+                    break
+                res.append(picture)
+            return res
+
+    def mosaic(self, picture):
+        with self.condition:
+            return self.mosaics.get(picture)
+
+    def take_tile(self, picture):
+        with self.condition:
+            self.condition.notify_all()
+            return self.tiles.pop(picture, None)
+
+    def take_texture(self, picture):
+        with self.condition:
+            return self.textures.pop(picture, None)
+
+    def run(self):
+        generation = None
+        while True:
+            with self.condition:
+                while self.generation == generation and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                generation = self.generation
+            pictures = self.walk.peek(self.steps)
+            with self.condition:
+                self.pictures = pictures
+                # forgets what the walk doesn't need anymore
+                self.mosaics = {
+                    p: self.mosaics[p] for p in pictures if p in self.mosaics
+                }
+                self.textures = {
+                    p: self.textures[p] for p in pictures if p in self.textures
+                }
+                needed = {
+                    tile
+                    for mosaic in self.mosaics.values()
+                    for line in mosaic
+                    for tile in line
+                }
+                self.tiles = {t: self.tiles[t] for t in needed if t in self.tiles}
+            for picture in pictures:
+                if not self.prepare(picture, generation):
+                    break
+
+    def current(self, generation):
+        # whether the walk is still at generation, under self.condition
+        return self.generation == generation and not self.stopped
+
+    def prepare(self, picture, generation):
+        """Returns False if the walk took a step or the prefetcher was closed
+        meanwhile
+        """
+        mosaic = self.mosaic(picture)
+        if mosaic is None:
+            mosaic = self.get_mosaic(picture)
+            with self.condition:
+                self.mosaics[picture] = mosaic
+        tiles = {tile for line in mosaic for tile in line}
+        tiles = [
+            tile
+            for tile in tiles
+            if tile not in self.tiles and not self.resident("tile", tile)
+        ]
+        for start in range(0, len(tiles), TILES_BATCH_SIZE):
+            batch = tiles[start:][:TILES_BATCH_SIZE]
+            with self.condition:
+                while len(self.tiles) >= self.max_tiles and self.current(generation):
+                    self.condition.wait()
+                if not self.current(generation):
+                    return False
+            prepared = list(self.executor.map(self.get_tile_data, batch))
+            with self.condition:
+                self.tiles.update(zip(batch, prepared))
+        with self.condition:
+            if not self.current(generation):
+                return False
+        if picture not in self.textures and not self.resident("texture", picture):
+            prepared = self.get_picture_data(picture)
+            with self.condition:
+                self.textures[picture] = prepared
+        with self.condition:
+            return self.current(generation)
@@ -0,0 +1,537 @@
+from collections import Counter, OrderedDict
+
+import numpy as np
+from OpenGL.GL import (
+    GL_ARRAY_BUFFER,
+    GL_FRAGMENT_SHADER,
+    GL_LINEAR,
+    GL_LINEAR_MIPMAP_LINEAR,
+    GL_MAX_ARRAY_TEXTURE_LAYERS,
+    GL_MAX_TEXTURE_SIZE,
+    GL_NEAREST,
+    GL_RGB,
+    GL_RGB8,
+    GL_STATIC_DRAW,
+    GL_TEXTURE_2D,
+    GL_TEXTURE_2D_ARRAY,
+    GL_TEXTURE_MAG_FILTER,
+    GL_TEXTURE_MAX_LEVEL,
+    GL_TEXTURE_MIN_FILTER,
+    GL_TRIANGLE_STRIP,
+    GL_TRUE,
+    GL_UNPACK_ALIGNMENT,
+    GL_UNSIGNED_BYTE,
+    GL_UNSIGNED_INT,
+    GL_VERTEX_SHADER,
+    glBindBuffer,
+    glBindTexture,
+    glBindVertexArray,
+    glBufferData,
+    glDeleteBuffers,
+    glDeleteTextures,
+    glDeleteVertexArrays,
+    glDrawArrays,
+    glDrawArraysInstanced,
+    glEnableVertexAttribArray,
+    glGenBuffers,
+    glGenTextures,
+    glGenVertexArrays,
+    glGetIntegerv,
+    glGetUniformLocation,
+    glPixelStorei,
+    glTexImage2D,
+    glTexImage3D,
+    glTexParameteri,
+    glTexSubImage3D,
+    glUniform1f,
+    glUniform1i,
+    glUniform2f,
+    glUniformMatrix4fv,
+    glUseProgram,
+    glVertexAttribDivisor,
+    glVertexAttribIPointer,
+)
+from OpenGL.GL.shaders import compileProgram, compileShader
+from PIL import Image
+
+from atlas import ATLAS_LEVELS, GUTTER, Atlas, tile_size
+from transition import ortho
+
+ATLAS_PAGE_SIZE = 4096
+# drivers usually store RGB8 textures with 4 bytes per texel
+BYTES_PER_TEXEL = 4
+
+# corners of the drawn quads come from gl_VertexID (triangle strip order)
+CORNER = """
+vec2 corner() {
+    return vec2(gl_VertexID & 1, gl_VertexID >> 1);
+}
+"""
+
+# one instance per tile: its cell comes from gl_InstanceID, the only instance
+# attribute is the atlas slot of the tile
+TILES_VERTEX_SHADER = (
+    """
+#version 330 core
+layout(location = 0) in uint slot;
+uniform mat4 transform;
+uniform int tiles;
+uniform vec2 tile_size;
+uniform int atlas_columns;
+uniform int atlas_rows;
+uniform vec2 slot_pixels;
+uniform vec2 tile_pixels;
+uniform float gutter;
+uniform float page_size;
+out vec3 texcoord;
+"""
+    + CORNER
+    + """
+void main() {
+    vec2 cell = vec2(gl_InstanceID % tiles, gl_InstanceID / tiles);
+    gl_Position = transform * vec4((cell + corner()) * tile_size, 0.0, 1.0);
+    int page_slot = int(slot) % (atlas_columns * atlas_rows);
+    vec2 origin = vec2(page_slot % atlas_columns, page_slot / atlas_columns);
+    texcoord = vec3(
+        (origin * slot_pixels + gutter + corner() * tile_pixels) / page_size,
+        int(slot) / (atlas_columns * atlas_rows)
+    );
+}
+"""
+)
+TILES_FRAGMENT_SHADER = """
+#version 330 core
+in vec3 texcoord;
+uniform sampler2DArray atlas;
+uniform float alpha;
+out vec4 color;
+void main() {
+    color = vec4(texture(atlas, texcoord).rgb, alpha);
+}
+"""
+PICTURE_VERTEX_SHADER = (
+    """
+#version 330 core
+uniform mat4 transform;
+uniform vec2 position;
+uniform vec2 size;
+out vec2 texcoord;
+"""
+    + CORNER
+    + """
+void main() {
+    gl_Position = transform * vec4(position + corner() * size, 0.0, 1.0);
+    texcoord = corner();
+}
+"""
+)
+PICTURE_FRAGMENT_SHADER = """
+#version 330 core
+in vec2 texcoord;
+uniform sampler2D picture;
+uniform float alpha;
+out vec4 color;
+void main() {
+    color = vec4(texture(picture, texcoord).rgb, alpha);
+}
+"""
+
+
+def set_filters(target):
+    # trilinear filtering
+    glTexParameteri(target, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameteri(target, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+
+
+def mipmaps(image, levels=None):
+    """RGB arrays of the mipmap levels of a PIL image, down to 1x1 by default,
+    bottom line first as OpenGL expects them
+    """
+    image = image.convert("RGB")
+    res = [np.ascontiguousarray(np.asarray(image)[::-1])]
+    while (levels is None or len(res) < levels) and max(image.size) > 1:
+        width, height = image.size
+        image = image.resize(
+            (max(1, width // 2), max(1, height // 2)), Image.Resampling.BOX
+        )
+        res.append(np.ascontiguousarray(np.asarray(image)[::-1]))
+    return res
+
+
+def picture_data(image):
+    """Mipmap levels of a PIL image, ready to be uploaded by
+    Renderer.load_picture()
+    """
+    return mipmaps(image)
+
+
+def tile_data(image):
+    """Mipmap levels of a tile_size PIL image, ready to be uploaded by
+    Renderer.load_tile()
+    """
+    res = []
+    for level, pixels in enumerate(mipmaps(image, ATLAS_LEVELS)):
+        gutter = GUTTER >> level
+        pixels = np.pad(pixels, ((gutter, gutter), (gutter, gutter), (0, 0)), "edge")
+        res.append(np.ascontiguousarray(pixels))
+    return res
+
+
+class Renderer(object):
+    """Draws each mosaic with one instanced draw call: tiles are sampled from
+    an array texture whose layers are the atlas pages, the instance buffer of a
+    mosaic only holds the atlas slot of each tile. Photos drawn on their own
+    have their own texture. All textures are mipmapped and filtered
+    trilinearly.
+    Textures and mosaics are loaded on demand. Once they take more than the
+    budget left by the atlas, the least recently used ones that the current
+    frame doesn't need are unloaded. The atlas has the pages the library needs
+    within half the budget, but at least enough for the tiles of min_mosaics
+    mosaics. When it is full, tiles that no loaded mosaic uses are replaced.
+    Requires OpenGL 3.3.
+    """
+
+    def __init__(
+        self, ratio, tiles, tile_pixels, pictures_count, budget, min_mosaics=2
+    ):
+        self.ratio = ratio
+        self.tiles = tiles
+        self.budget = budget
+        max_size = min(ATLAS_PAGE_SIZE, glGetIntegerv(GL_MAX_TEXTURE_SIZE))
+        self.tile_size = tile_size(ratio, tile_pixels)
+        slot_width, slot_height = (length + 2 * GUTTER for length in self.tile_size)
+        self.atlas = Atlas(slot_width, slot_height, max_size)
+        # small libraries fit in smaller pages
+        while max_size // 2 >= max(slot_width, slot_height):
+            atlas = Atlas(slot_width, slot_height, max_size // 2)
+            if atlas.page_capacity < pictures_count:
+                break
+            self.atlas, max_size = atlas, max_size // 2
+        page_bytes = self.level_bytes(max_size**2)
+        needed = -(-pictures_count // self.atlas.page_capacity)
+        minimum = -(
+            -min(pictures_count, min_mosaics * tiles**2) // self.atlas.page_capacity
+        )
+        self.atlas.pages = max(minimum, min(needed, budget // 2 // page_bytes))
+        if self.atlas.pages > glGetIntegerv(GL_MAX_ARRAY_TEXTURE_LAYERS):
+            raise ValueError("{} atlas pages are too many".format(self.atlas.pages))
+        self.textures = {}
+        # picture to (vertex array, instance buffer, tiles)
+        self.mosaics = {}
+        # ("texture" or "mosaic", picture) to its size in bytes, from the least
+        # recently used, and to the last frame using it
+        self.lru = OrderedDict()
+        self.used = {}
+        self.frame = 0
+        self.resident_bytes = 0
+        # tiles in the atlas that no loaded mosaic uses, from the least recently
+        # released
+        self.idle_tiles = OrderedDict()
+        self.tile_users = Counter()
+        self.stats = Counter()
+        self.uniforms = {}
+        self.overlay = None
+        self.overlay_size = (0, 0)
+        self.atlas_texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.atlas_texture)
+        for level in range(ATLAS_LEVELS):
+            glTexImage3D(
+                GL_TEXTURE_2D_ARRAY,
+                level,
+                GL_RGB8,
+                self.atlas.page_size >> level,
+                self.atlas.page_size >> level,
+                self.atlas.pages,
+                0,
+                GL_RGB,
+                GL_UNSIGNED_BYTE,
+                None,
+            )
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAX_LEVEL, ATLAS_LEVELS - 1)
+        set_filters(GL_TEXTURE_2D_ARRAY)
+        self.tiles_program = compileProgram(
+            compileShader(TILES_VERTEX_SHADER, GL_VERTEX_SHADER),
+            compileShader(TILES_FRAGMENT_SHADER, GL_FRAGMENT_SHADER),
+        )
+        self.picture_program = compileProgram(
+            compileShader(PICTURE_VERTEX_SHADER, GL_VERTEX_SHADER),
+            compileShader(PICTURE_FRAGMENT_SHADER, GL_FRAGMENT_SHADER),
+        )
+        # drawing pictures needs no vertex attribute but a bound vertex array
+        self.empty_vertex_array = glGenVertexArrays(1)
+        glUseProgram(self.tiles_program)
+        self.set_uniform(self.tiles_program, "tiles", glUniform1i, tiles)
+        self.set_uniform(self.tiles_program, "tile_size", glUniform2f, ratio, 1.0)
+        self.set_uniform(
+            self.tiles_program, "atlas_columns", glUniform1i, self.atlas.columns
+        )
+        self.set_uniform(self.tiles_program, "atlas_rows", glUniform1i, self.atlas.rows)
+        self.set_uniform(
+            self.tiles_program,
+            "slot_pixels",
+            glUniform2f,
+            self.atlas.tile_width,
+            self.atlas.tile_height,
+        )
+        self.set_uniform(
+            self.tiles_program, "tile_pixels", glUniform2f, *self.tile_size
+        )
+        self.set_uniform(self.tiles_program, "gutter", glUniform1f, GUTTER)
+        self.set_uniform(
+            self.tiles_program, "page_size", glUniform1f, self.atlas.page_size
+        )
+        glUseProgram(0)
+
+    def set_uniform(self, program, name, setter, *values):
+        key = (program, name)
+        if key not in self.uniforms:
+            self.uniforms[key] = glGetUniformLocation(program, name)
+        setter(self.uniforms[key], *values)
+
+    def set_transform(self, program, transform):
+        self.set_uniform(
+            program,
+            "transform",
+            glUniformMatrix4fv,
+            1,
+            GL_TRUE,
+            transform.astype(np.float32),
+        )
+
+    @staticmethod
+    def level_bytes(texels):
+        # with mipmaps, a third more than the first level
+        return texels * BYTES_PER_TEXEL * 4 // 3
+
+    @property
+    def atlas_bytes(self):
+        return self.atlas.pages * self.level_bytes(self.atlas.page_size**2)
+
+    def begin_frame(self):
+        self.frame += 1
+
+    def lookup(self, kind, picture, prefetch=False):
+        """Whether the "texture" or the "mosaic" of picture is loaded, which then
+        can't be unloaded during the current frame. Hits and misses are counted
+        unless prefetching.
+        """
+        key = (kind, picture)
+        resident = key in self.lru
+        if resident:
+            self.lru.move_to_end(key)
+            self.used[key] = self.frame
+        if not prefetch:
+            self.stats["{} {}".format(kind, "hits" if resident else "misses")] += 1
+        return resident
+
+    def add(self, kind, picture, size):
+        key = (kind, picture)
+        self.lru[key] = size
+        self.used[key] = self.frame
+        self.resident_bytes += size
+        budget = self.budget - self.atlas_bytes
+        for key in list(self.lru):
+            if self.resident_bytes <= budget:
+                break
+            if self.used[key] != self.frame:
+                self.unload(*key)
+
+    def unload(self, kind, picture):
+        key = (kind, picture)
+        self.resident_bytes -= self.lru.pop(key)
+        del self.used[key]
+        self.stats[kind + " evictions"] += 1
+        if kind == "texture":
+            glDeleteTextures([self.textures.pop(picture)])
+        else:
+            vertex_array, buffer, tiles = self.mosaics.pop(picture)
+            glDeleteVertexArrays(1, [vertex_array])
+            glDeleteBuffers(1, [buffer])
+            self.release_tiles(tiles)
+
+    def hold_tiles(self, tiles):
+        for tile in tiles:
+            self.idle_tiles.pop(tile, None)
+            self.tile_users[tile] += 1
+
+    def release_tiles(self, tiles):
+        for tile in tiles:
+            self.tile_users[tile] -= 1
+            if self.tile_users[tile] == 0 and tile in self.atlas:
+                self.idle_tiles[tile] = None
+
+    def load_picture(self, picture, levels):
+        """Full resolution texture of picture, see picture_data()"""
+        _id = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, _id)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        for level, pixels in enumerate(levels):
+            glTexImage2D(
+                GL_TEXTURE_2D,
+                level,
+                GL_RGB8,
+                pixels.shape[1],
+                pixels.shape[0],
+                0,
+                GL_RGB,
+                GL_UNSIGNED_BYTE,
+                pixels,
+            )
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+        set_filters(GL_TEXTURE_2D)
+        self.textures[picture] = _id
+        self.stats["texture uploads"] += 1
+        self.stats["uploaded bytes"] += sum(pixels.nbytes for pixels in levels)
+        self.add(
+            "texture",
+            picture,
+            self.level_bytes(levels[0].shape[0] * levels[0].shape[1]),
+        )
+
+    def free_atlas_slot(self):
+        while self.atlas.full():
+            if self.idle_tiles:
+                tile, _ = self.idle_tiles.popitem(last=False)
+                self.atlas.remove(tile)
+                self.stats["tile evictions"] += 1
+                continue
+            key = next(
+                (
+                    key
+                    for key in self.lru
+                    if key[0] == "mosaic" and self.used[key] != self.frame
+                ),
+                None,
+            )
+            if key is None:
+                raise ValueError("the atlas can't hold the tiles of the mosaics in use")
+            self.unload(*key)
+
+    def load_tile(self, picture, levels):
+        """Copies a tile of picture in the atlas, see tile_data()"""
+        self.free_atlas_slot()
+        page, x, y = self.atlas.add(picture)
+        if self.tile_users[picture] <= 0:
+            self.idle_tiles[picture] = None
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.atlas_texture)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        for level, pixels in enumerate(levels):
+            glTexSubImage3D(
+                GL_TEXTURE_2D_ARRAY,
+                level,
+                x >> level,
+                y >> level,
+                page,
+                pixels.shape[1],
+                pixels.shape[0],
+                1,
+                GL_RGB,
+                GL_UNSIGNED_BYTE,
+                pixels,
+            )
+        self.stats["tile uploads"] += 1
+        self.stats["uploaded bytes"] += sum(pixels.nbytes for pixels in levels)
+
+    def load_mosaic(self, picture, mosaic, get_tile_data, limit=None):
+        """Loads at most limit of the missing tiles of mosaic (lines of tiles from
+        the top), then its instance buffer once all its tiles are in the atlas.
+        get_tile_data(tile) gives the tile_data() of a tile, or None when it isn't
+        available yet. Returns whether the mosaic is loaded.
+        """
+        if picture in self.mosaics:
+            return True
+        tiles = {tile for line in mosaic for tile in line}
+        # loading some tiles must not replace the others
+        self.hold_tiles(tiles)
+        loaded = 0
+        for tile in tiles:
+            if limit is not None and loaded >= limit:
+                break
+            if tile not in self.atlas:
+                levels = get_tile_data(tile)
+                if levels is not None:
+                    self.load_tile(tile, levels)
+                    loaded += 1
+        if any(tile not in self.atlas for tile in tiles):
+            self.release_tiles(tiles)
+            return False
+        # instance i is the tile of column i % tiles from the bottom line
+        slots = np.array(
+            [[self.atlas.slots[tile] for tile in line] for line in mosaic[::-1]],
+            dtype=np.uint32,
+        )
+        vertex_array = glGenVertexArrays(1)
+        glBindVertexArray(vertex_array)
+        buffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, buffer)
+        glBufferData(GL_ARRAY_BUFFER, slots.nbytes, slots, GL_STATIC_DRAW)
+        glEnableVertexAttribArray(0)
+        glVertexAttribIPointer(0, 1, GL_UNSIGNED_INT, 0, None)
+        glVertexAttribDivisor(0, 1)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.mosaics[picture] = (vertex_array, buffer, tiles)
+        self.add("mosaic", picture, slots.nbytes)
+        return True
+
+    def draw_mosaic(self, picture, transform, alpha):
+        """Draws the mosaic of picture in a ratio x 1 rectangle per tile"""
+        glUseProgram(self.tiles_program)
+        self.set_transform(self.tiles_program, transform)
+        self.set_uniform(self.tiles_program, "alpha", glUniform1f, alpha)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.atlas_texture)
+        glBindVertexArray(self.mosaics[picture][0])
+        glDrawArraysInstanced(GL_TRIANGLE_STRIP, 0, 4, self.tiles**2)
+        glBindVertexArray(0)
+        glUseProgram(0)
+
+    def load_overlay(self, image):
+        """Replaces the PIL image drawn by draw_overlay()"""
+        if self.overlay is None:
+            self.overlay = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.overlay)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        (pixels,) = mipmaps(image, 1)
+        glTexImage2D(
+            GL_TEXTURE_2D,
+            0,
+            GL_RGB8,
+            image.width,
+            image.height,
+            0,
+            GL_RGB,
+            GL_UNSIGNED_BYTE,
+            pixels,
+        )
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, 0)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        self.overlay_size = image.size
+
+    def draw_overlay(self, window_width, window_height, alpha):
+        """Draws the overlay pixel for pixel in the top left corner"""
+        width, height = self.overlay_size
+        self.draw_texture(
+            self.overlay,
+            ortho(0, window_width, 0, window_height),
+            0,
+            window_height - height,
+            width,
+            height,
+            alpha,
+        )
+
+    def draw_picture(self, picture, transform, x, y, width, height, alpha):
+        self.draw_texture(self.textures[picture], transform, x, y, width, height, alpha)
+
+    def draw_texture(self, texture, transform, x, y, width, height, alpha):
+        glUseProgram(self.picture_program)
+        self.set_transform(self.picture_program, transform)
+        self.set_uniform(self.picture_program, "position", glUniform2f, x, y)
+        self.set_uniform(self.picture_program, "size", glUniform2f, width, height)
+        self.set_uniform(self.picture_program, "alpha", glUniform1f, alpha)
+        glBindTexture(GL_TEXTURE_2D, texture)
+        glBindVertexArray(self.empty_vertex_array)
+        glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+        glBindVertexArray(0)
+        glUseProgram(0)
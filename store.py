@@ -0,0 +1,357 @@
+import functools
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from os import listdir, makedirs, path, remove, rmdir
+from shutil import rmtree
+
+import numpy as np
+
+from cache import CACHE_DIR
+from mosaicarray import MosaicArray
+
+DATABASE = path.join(CACHE_DIR, "cache.sqlite")
+IMAGE_FIELDS = ("ratio", "orientation", "width", "height")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    hash TEXT PRIMARY KEY,
+    red INTEGER NOT NULL,
+    green INTEGER NOT NULL,
+    blue INTEGER NOT NULL,
+    ratio REAL NOT NULL,
+    orientation INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL
+);
+-- features holds the little endian float32 descriptors of an image for a metric
+CREATE TABLE IF NOT EXISTS features (
+    hash TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    features BLOB NOT NULL,
+    PRIMARY KEY (hash, metric)
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+-- images are concatenations of fixed width image hashes
+CREATE TABLE IF NOT EXISTS libraries (
+    hash TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    updated REAL NOT NULL,
+    count INTEGER NOT NULL,
+    images TEXT NOT NULL
+);
+-- tour holds little endian uint32 positions in the sorted images hashes of the
+-- library
+CREATE TABLE IF NOT EXISTS tours (
+    library TEXT NOT NULL,
+    nb_segments INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    tour BLOB NOT NULL,
+    PRIMARY KEY (library, nb_segments, mode)
+);
+"""
+
+
+def split(data, count):
+    if count == 0:
+        return []
+    width = len(data) // count
+    bounds = range(0, len(data) + 1, width)
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def library_hash(hashes):
+    """Hash identifying the library of the images hashes"""
+    return hashlib.md5("".join(sorted(hashes)).encode("utf8")).hexdigest()
+
+
+def read_json(fpath):
+    try:
+        with open(fpath, "r") as f:
+            return json.load(f)
+    except (IOError, json.JSONDecodeError):
+        return None
+
+
+def synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Store(object):
+    """All images metadata and features, libraries and tours in a single SQLite
+    database and mosaics in a MosaicArray file per library, tiles count and mode
+    next to it.
+    Writes of several rows happen in one transaction. The connection can be
+    shared by several threads.
+    """
+
+    def __init__(self, fpath=DATABASE):
+        makedirs(path.dirname(fpath), exist_ok=True)
+        self.dir = path.dirname(fpath)
+        self.lock = threading.RLock()
+        self.arrays = {}
+        self.connection = sqlite3.connect(fpath, check_same_thread=False)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        if version == 0:
+            self.migrate_json_files()
+            with self.connection:
+                self.connection.execute("PRAGMA user_version = 1")
+
+    @synchronized
+    def images(self):
+        res = {}
+        for row in self.connection.execute("SELECT * FROM images"):
+            res[row[0]] = dict(zip(IMAGE_FIELDS, row[4:]), average_color=row[1:4])
+        return res
+
+    @synchronized
+    def add_images(self, images):
+        """images: dict of hash to metadata dict"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (h, *data["average_color"], *(data[f] for f in IMAGE_FIELDS))
+                    for h, data in images.items()
+                ],
+            )
+
+    @synchronized
+    def features(self, metric):
+        """dict of image hash to its descriptors array for metric"""
+        return {
+            row[0]: np.frombuffer(row[1], dtype="<f4")
+            for row in self.connection.execute(
+                "SELECT hash, features FROM features WHERE metric = ?", (metric,)
+            )
+        }
+
+    @synchronized
+    def add_features(self, metric, features):
+        """features: dict of image hash to descriptors array"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO features VALUES (?, ?, ?)",
+                [
+                    (h, metric, np.asarray(data, dtype="<f4").tobytes())
+                    for h, data in features.items()
+                ],
+            )
+
+    @synchronized
+    def fingerprints(self, algorithm):
+        """dict of path to ((size, mtime_ns, inode), hash)"""
+        return {
+            row[0]: (row[1:4], row[4])
+            for row in self.connection.execute(
+                "SELECT path, size, mtime_ns, inode, hash FROM fingerprints"
+                " WHERE algorithm = ?",
+                (algorithm,),
+            )
+        }
+
+    @synchronized
+    def add_fingerprints(self, algorithm, fingerprints):
+        """fingerprints: dict of path to ((size, mtime_ns, inode), hash)"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (fpath, algorithm, *stat, h)
+                    for fpath, (stat, h) in fingerprints.items()
+                ],
+            )
+
+    @synchronized
+    def fingerprinted_files(self):
+        """(path, hash) of the fingerprints of all algorithms"""
+        return self.connection.execute("SELECT path, hash FROM fingerprints").fetchall()
+
+    @synchronized
+    def image_hashes(self):
+        """Hashes of the images having metadata, features or a fingerprint"""
+        return {
+            row[0]
+            for row in self.connection.execute(
+                "SELECT hash FROM images UNION SELECT hash FROM features"
+                " UNION SELECT hash FROM fingerprints"
+            )
+        }
+
+    @synchronized
+    def remove_images(self, hashes, paths):
+        """Forgets the metadata and features of the images hashes and the
+        fingerprints of the files paths
+        """
+        with self.connection:
+            for table in ("images", "features"):
+                self.connection.executemany(
+                    "DELETE FROM {} WHERE hash = ?".format(table),
+                    [(h,) for h in hashes],
+                )
+            self.connection.executemany(
+                "DELETE FROM fingerprints WHERE path = ?", [(p,) for p in paths]
+            )
+
+    @synchronized
+    def add_library(self, library, folder, images):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO libraries VALUES (?, ?, ?, ?, ?)",
+                (library, folder, time.time(), len(images), "".join(images)),
+            )
+
+    @synchronized
+    def library_images(self, library):
+        row = self.connection.execute(
+            "SELECT count, images FROM libraries WHERE hash = ?", (library,)
+        ).fetchone()
+        return None if row is None else split(row[1], row[0])
+
+    @synchronized
+    def previous_library(self, folder, library, nb_segments, mode):
+        """Most recently used other library of folder having mosaics"""
+        for (previous,) in self.connection.execute(
+            "SELECT hash FROM libraries WHERE folder = ? AND hash != ?"
+            " ORDER BY updated DESC",
+            (folder, library),
+        ).fetchall():
+            if path.exists(self.mosaics_path(previous, nb_segments, mode)):
+                return previous
+        return None
+
+    @synchronized
+    def libraries(self):
+        """(library, folder) of all libraries, the most recently used last"""
+        return self.connection.execute(
+            "SELECT hash, folder FROM libraries ORDER BY updated"
+        ).fetchall()
+
+    def mosaics_dir(self, library):
+        return path.join(self.dir, "mosaics", library)
+
+    @synchronized
+    def remove_libraries(self, libraries):
+        """Forgets libraries with their tours and removes their mosaics"""
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM libraries WHERE hash = ?", [(lib,) for lib in libraries]
+            )
+            self.connection.executemany(
+                "DELETE FROM tours WHERE library = ?", [(lib,) for lib in libraries]
+            )
+        for key in [key for key in self.arrays if key[0] in libraries]:
+            del self.arrays[key]
+        for library in libraries:
+            rmtree(self.mosaics_dir(library), ignore_errors=True)
+
+    def mosaics_path(self, library, nb_segments, mode):
+        return path.join(
+            self.mosaics_dir(library), "{}-{}.mosaics".format(nb_segments, mode)
+        )
+
+    @synchronized
+    def mosaic_array(self, library, nb_segments, mode, hashes):
+        """MosaicArray of library, hashes are the sorted hashes of its images"""
+        key = (library, nb_segments, mode)
+        array = self.arrays.get(key)
+        if array is None or array.hashes != list(hashes):
+            array = MosaicArray(self.mosaics_path(*key), hashes, nb_segments)
+            self.arrays[key] = array
+        return array
+
+    def import_mosaics(self, library, nb_segments, mode, mosaics):
+        """mosaics: dict of image hash to lines of tiles hashes. Without the
+        images of library, they are only imported if they use all of them: the
+        positions of the tiles are relative to that list.
+        """
+        hashes = self.library_images(library)
+        if hashes is None:
+            hashes = set(mosaics)
+            for lines in mosaics.values():
+                for line in lines:
+                    hashes.update(line)
+            if library_hash(hashes) != library:
+                return
+        array = self.mosaic_array(library, nb_segments, mode, sorted(hashes))
+        for image, lines in mosaics.items():
+            array[array.positions[image]] = [
+                [array.positions[h] for h in line] for line in lines
+            ]
+        array.flush()
+
+    @synchronized
+    def tour(self, library, nb_segments, mode):
+        row = self.connection.execute(
+            "SELECT tour FROM tours WHERE library = ? AND nb_segments = ? AND mode = ?",
+            (library, nb_segments, mode),
+        ).fetchone()
+        return None if row is None else np.frombuffer(row[0], dtype="<u4").tolist()
+
+    @synchronized
+    def set_tour(self, library, nb_segments, mode, tour):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tours VALUES (?, ?, ?, ?)",
+                (
+                    library,
+                    nb_segments,
+                    mode,
+                    np.asarray(tour, dtype="<u4").tobytes(),
+                ),
+            )
+
+    def migrate_json_files(self):
+        """Imports the former images/<hash>/data.json and
+        mosaics/<library>/<nb_segments>/<mode>/*.json files of the cache directory.
+        """
+        images_dir = path.join(self.dir, "images")
+        images = {}
+        for image in listdir(images_dir) if path.isdir(images_dir) else []:
+            fpath = path.join(images_dir, image, "data.json")
+            data = read_json(fpath)
+            if data is not None:
+                images[image] = data
+        self.add_images(images)
+        for image in images:
+            remove(path.join(images_dir, image, "data.json"))
+        mosaics_dir = path.join(self.dir, "mosaics")
+        for library in listdir(mosaics_dir) if path.isdir(mosaics_dir) else []:
+            library_dir = path.join(mosaics_dir, library)
+            for nb_segments in filter(str.isdigit, listdir(library_dir)):
+                segments_dir = path.join(library_dir, nb_segments)
+                for mode in listdir(segments_dir):
+                    self.migrate_mosaics_dir(
+                        path.join(segments_dir, mode), library, int(nb_segments), mode
+                    )
+                if not listdir(segments_dir):
+                    rmdir(segments_dir)
+
+    def migrate_mosaics_dir(self, dir, library, nb_segments, mode):
+        mosaics = {}
+        for name in listdir(dir):
+            data = read_json(path.join(dir, name))
+            if name.endswith(".json") and name != "graph.json" and data is not None:
+                mosaics[name[: -len(".json")]] = data
+        self.import_mosaics(library, nb_segments, mode, mosaics)
+        for name in listdir(dir):
+            if name.endswith(".json"):
+                remove(path.join(dir, name))
+        if not listdir(dir):
+            rmdir(dir)
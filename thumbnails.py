@@ -0,0 +1,124 @@
+import re
+import time
+from os import getpid, listdir, makedirs, path, remove, replace, scandir, utime
+from shutil import rmtree
+
+from cache import CACHE_DIR
+
+THUMBNAILS_DIR = path.join(CACHE_DIR, "images")
+# PIL format and file extension of each thumbnail format
+FORMATS = {"jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp"), "png": ("PNG", ".png")}
+EXTENSIONS = {extension: name for name, extension in FORMATS.values()}
+THUMBNAIL_NAME = re.compile(r"\d+x\d+\.[a-z]+")
+# seconds after which a temporary file is left over from an interrupted write
+# rather than being written
+TMP_FILES_AGE = 3600
+
+
+class Thumbnails(object):
+    """Resized copies of images, in dir/<image hash>/<width>x<height>.<extension>.
+    They are written in format, with quality for jpeg and webp, unless they must
+    be lossless. Their modification time is the last time they were used: trim()
+    removes the least recently used ones beyond budget bytes (unbounded if None).
+    """
+
+    def __init__(self, format="jpeg", quality=90, budget=None, dir=THUMBNAILS_DIR):
+        self.format = format
+        self.quality = quality
+        self.budget = budget
+        self.dir = dir
+
+    def path(self, hash, width, height, lossless=False):
+        _, extension = FORMATS["png" if lossless else self.format]
+        return path.join(self.dir, hash, "{}x{}{}".format(width, height, extension))
+
+    def save(self, image, fpath):
+        makedirs(path.dirname(fpath), exist_ok=True)
+        name = EXTENSIONS[path.splitext(fpath)[1]]
+        options = {} if name == "PNG" else {"quality": self.quality}
+        # other processes may read it meanwhile
+        tmp_path = "{}.{}.tmp".format(fpath, getpid())
+        image.save(tmp_path, name, **options)
+        replace(tmp_path, fpath)
+
+    @staticmethod
+    def touch(fpath):
+        """Marks the thumbnail fpath as used now"""
+        try:
+            utime(fpath)
+        except OSError:
+            pass
+
+    def hashes(self):
+        return listdir(self.dir) if path.isdir(self.dir) else []
+
+    def files(self, hashes=None):
+        """(modification time, size, path) of the thumbnails of hashes, all of
+        them by default
+        """
+        for h in self.hashes() if hashes is None else hashes:
+            try:
+                entries = list(scandir(path.join(self.dir, h)))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, entry.path
+
+    def legacy_files(self):
+        """Thumbnails written by former versions, as PNG files without extension,
+        and temporary files of interrupted writes
+        """
+        now = time.time()
+        return [
+            (size, fpath)
+            for mtime, size, fpath in self.files()
+            if not THUMBNAIL_NAME.fullmatch(path.basename(fpath))
+            and not (fpath.endswith(".tmp") and now - mtime < TMP_FILES_AGE)
+        ]
+
+    def trim(self, dry_run=False):
+        """Removes the least recently used thumbnails until they fit in the
+        budget, returns the number of files and bytes removed
+        """
+        if self.budget is None:
+            return 0, 0
+        files = sorted(self.files())
+        total = sum(size for _, size, _ in files)
+        removed = []
+        for _, size, fpath in files:
+            if total <= self.budget:
+                break
+            removed.append((size, fpath))
+            total -= size
+        return self.remove_files(removed, dry_run)
+
+    def remove_hashes(self, hashes, dry_run=False):
+        """Removes all the thumbnails of hashes, returns the number of files and
+        bytes removed
+        """
+        files = [(size, fpath) for _, size, fpath in self.files(hashes)]
+        if not dry_run:
+            for h in hashes:
+                rmtree(path.join(self.dir, h), ignore_errors=True)
+        return len(files), sum(size for size, _ in files)
+
+    @staticmethod
+    def remove_files(files, dry_run=False):
+        """files: list of (size, path), returns the number of files and bytes
+        removed
+        """
+        count = 0
+        total = 0
+        for size, fpath in files:
+            try:
+                if not dry_run:
+                    remove(fpath)
+            except FileNotFoundError:
+                continue
+            count += 1
+            total += size
+        return count, total
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import itertools
+
+import numpy as np
+
+from colorindex import concatenated_ranges
+from graph import biggest_strongly_connected_component, load_from_cache
+from instrumentation import timed
+
+
+def predecessors_graph(graph):
+    """offsets and sources of the reversed edges, in compressed sparse row form"""
+    count = len(graph)
+    sources = np.repeat(np.arange(count), np.diff(graph.offsets))
+    order = np.argsort(graph.targets, kind="stable")
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(graph.targets, minlength=count), out=offsets[1:])
+    return offsets, sources[order]
+
+
+def shortest_path(graph, source, targets):
+    """Node ids of a shortest path from source to one of the nodes of the targets
+    boolean mask, source excluded, or None if there is none
+    """
+    previous = np.full(len(graph), -1, dtype=np.int64)
+    previous[source] = source
+    frontier = np.array([source], dtype=np.int64)
+    while len(frontier):
+        starts = graph.offsets[frontier]
+        lengths = graph.offsets[frontier + 1] - starts
+        successors = graph.targets[concatenated_ranges(starts, lengths)]
+        parents = np.repeat(frontier, lengths)
+        new = previous[successors] == -1
+        frontier, first = np.unique(successors[new], return_index=True)
+        previous[frontier] = parents[new][first]
+        found = frontier[targets[frontier]]
+        if len(found):
+            node = int(found[0])
+            res = []
+            while node != source:
+                res.append(node)
+                node = int(previous[node])
+            return res[::-1]
+    return None
+
+
+@timed("tour planning")
+def plan_tour(graph, start=0):
+    """Node ids of a closed walk through all the nodes of a strongly connected
+    graph, the last one leading back to the first one. The walk goes to unvisited
+    successors while there are some, the one having the fewest unvisited
+    successors first (Warnsdorff's rule) so that few nodes get isolated. Once
+    stuck, it follows the shortest path to the nearest unvisited node.
+    """
+    offsets, sources = predecessors_graph(graph)
+    unvisited = np.ones(len(graph), dtype=bool)
+    # number of unvisited successors of each node
+    remaining = np.diff(graph.offsets)
+    tour = []
+
+    def visit(node):
+        tour.append(node)
+        if unvisited[node]:
+            unvisited[node] = False
+            first, last = offsets[node], offsets[node + 1]
+            remaining[sources[first:last]] -= 1
+
+    visit(start)
+    node = start
+    while unvisited.any():
+        successors = graph.successors(node)
+        candidates = successors[unvisited[successors]]
+        if len(candidates):
+            node = int(candidates[remaining[candidates].argmin()])
+            visit(node)
+        else:
+            for node in shortest_path(graph, node, unvisited):
+                visit(node)
+    if len(graph) > 1:
+        targets = np.zeros(len(graph), dtype=bool)
+        targets[start] = True
+        # the walk goes back to start after its last node
+        for node in shortest_path(graph, node, targets)[:-1]:
+            visit(node)
+    return tour
+
+
+def load_tour(mosaic_factory, nb_segments, reuse=True):
+    """Images of the tour of the biggest strongly connected component of the
+    transition graph, planned once and then read from the store
+    """
+    key = (mosaic_factory.hash(), nb_segments, mosaic_factory.mode(reuse))
+    images = list(mosaic_factory.images.values())
+    tour = mosaic_factory.store.tour(*key)
+    if tour is None:
+        component = biggest_strongly_connected_component(
+            load_from_cache(mosaic_factory, nb_segments, reuse)
+        )
+        print("planning tour:")
+        positions = {img: i for i, img in enumerate(images)}
+        tour = [positions[component.nodes[i]] for i in plan_tour(component)]
+        print(" {} steps through {} photos".format(len(tour), len(component.nodes)))
+        mosaic_factory.store.set_tour(*key, tour)
+    return [images[i] for i in tour]
+
+
+def tour_iterator(mosaic_factory, nb_segments, reuse=True):
+    return itertools.cycle(load_tour(mosaic_factory, nb_segments, reuse))
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    from mosaicfactory import MosaicFactory
+
+    # prints the tour of a folder: tour.py FOLDER [TILES]
+    mosaic_factory = MosaicFactory()
+    mosaic_factory.load(argv[1])
+    for img in load_tour(mosaic_factory, int(argv[2]) if len(argv) > 2 else 40):
+        print(img.path)
@@ -0,0 +1,119 @@
+from math import cos, exp, radians, sin
+
+import numpy as np
+
+# height of the scene, the mosaic of a photo of ratio r spans r × HEIGHT × HEIGHT
+HEIGHT = 100.0
+
+
+def sigmoid(value):
+    return 1.0 / (1.0 + exp(-float(value)))
+
+
+def sigmoid_0_1(value):
+    return sigmoid(value * 12.0 - 6.0)
+
+
+def fake_sigmoid(value):
+    if value == 0.0 or value == 1.0:
+        return value
+    delta = sigmoid_0_1(1) - sigmoid_0_1(0)
+    res = sigmoid_0_1(value) / delta - sigmoid_0_1(0)
+    if res < 0.0:
+        return 0.0
+    elif res > 1.0:
+        return 1.0
+    else:
+        return res
+
+
+def angle_difference(a1, a2):
+    difference = a1 - a2
+    if abs(difference) > 180:
+        difference = difference % 180
+        if a1 > a2:
+            difference = -difference
+    return difference
+
+
+def ortho(left, right, bottom, top):
+    return np.array(
+        [
+            [2 / (right - left), 0, 0, -(right + left) / (right - left)],
+            [0, 2 / (top - bottom), 0, -(top + bottom) / (top - bottom)],
+            [0, 0, -1, 0],
+            [0, 0, 0, 1],
+        ]
+    )
+
+
+def translation(x, y):
+    res = np.identity(4)
+    res[:2, 3] = x, y
+    return res
+
+
+def rotation(angle):
+    """Counterclockwise rotation around the z axis, angle is in degrees"""
+    res = np.identity(4)
+    c, s = cos(radians(angle)), sin(radians(angle))
+    res[:2, :2] = [[c, -s], [s, c]]
+    return res
+
+
+def scaling(factor):
+    return np.diag([factor, factor, 1.0, 1.0])
+
+
+def view_projection(width, height, ratio):
+    """Orthographic projection of the scene of a photo of ratio ratio, centered
+    in a width×height viewport
+    """
+    viewport_center = HEIGHT * width / height / 2
+    photo_center = HEIGHT * ratio / 2
+    return ortho(
+        photo_center - viewport_center, photo_center + viewport_center, 0.0, HEIGHT
+    )
+
+
+def find_picture_in_mosaic(picture, mosaic):
+    x = -1
+    for y, line in enumerate(mosaic):
+        if picture in line:
+            x = line.index(picture)
+            break
+    if x == -1:
+        raise Exception("picture not in mosaic")
+    return (x, len(mosaic) - y - 1)
+
+
+def zoom_out(progress, ratio, tiles, start_coord, start_orientation, orientation):
+    """Zoom, opacity of the mosaic and transform from the scene to the view at
+    progress, from 0 to 1, of the zoom out from the photo at start_coord (column,
+    line from the bottom) of a mosaic of tiles×tiles photos to the whole mosaic,
+    rotating from start_orientation to orientation
+    """
+    start_point = (
+        start_coord[0] * HEIGHT * ratio / (tiles - 1),
+        start_coord[1] * HEIGHT / (tiles - 1),
+    )
+    center = (HEIGHT * ratio / 2.0, HEIGHT / 2.0)
+    reverse_sigmoid_progress = fake_sigmoid(1 - progress)
+    sigmoid_progress = 1 - reverse_sigmoid_progress
+    zoom = tiles**reverse_sigmoid_progress
+    angle = start_orientation + sigmoid_progress * angle_difference(
+        orientation, start_orientation
+    )
+    if reverse_sigmoid_progress > 0.1:
+        alpha = 1.0
+    else:
+        alpha = reverse_sigmoid_progress * 10.0
+    transform = (
+        translation(center[0], center[1])
+        @ rotation(angle)
+        @ translation(-center[0], -center[1])
+        @ translation(start_point[0], start_point[1])
+        @ scaling(zoom)
+        @ translation(-start_point[0], -start_point[1])
+    )
+    return zoom, alpha, transform
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from itertools import islice
+from os import cpu_count, makedirs, path
+
+from PIL import Image
+
+from atlas import tile_size
+from compositor import Scene
+from graph import image_iterator
+from memoized import LRUCache
+from mosaicfactory import print_progress
+from options import (
+    create_mosaic_factory,
+    library_options,
+    thumbnails_options,
+    walk_options,
+)
+from tour import tour_iterator
+
+# frames rendered by each job
+FRAMES_PER_JOB = 8
+
+parser = argparse.ArgumentParser(
+    description="Renders the zoom outs of the photos mosaic visualization to video"
+    " frames",
+    parents=[library_options, thumbnails_options, walk_options],
+)
+parser.add_argument(
+    "output",
+    type=str,
+    help="folder where numbered PNG frames are written, or - to write raw rgb24"
+    " frames to the standard output",
+)
+parser.add_argument(
+    "-W", "--width", type=int, default=1920, help="frames width (defaults to 1920)"
+)
+parser.add_argument(
+    "-H", "--height", type=int, default=1080, help="frames height (defaults to 1080)"
+)
+parser.add_argument(
+    "-r", "--fps", type=float, default=30.0, help="frames per second (defaults to 30)"
+)
+parser.add_argument(
+    "-d", "--duration", type=float, default=10.0, help="zooming out duration in seconds"
+)
+parser.add_argument(
+    "-c",
+    "--count",
+    type=int,
+    default=10,
+    help="number of zoom outs rendered (defaults to 10)",
+)
+parser.add_argument(
+    "--tile-pixels",
+    type=int,
+    default=64,
+    help="height in pixels of the tiles textures (defaults to 64)",
+)
+
+# scene of the last zoom out rendered by this process
+scenes = LRUCache(max_size=1)
+
+
+def render_frames(index, scene_args, progresses, fpaths=None):
+    """Renders the frames at progresses of the index-th zoom out, saves them to
+    fpaths or returns their raw bytes
+    """
+    scene = scenes.get(index)
+    if scene is None:
+        scene = Scene(*scene_args)
+        scenes.put(index, scene)
+    frames = [scene.render(progress) for progress in progresses]
+    if fpaths is None:
+        return [frame.tobytes() for frame in frames]
+    for frame, fpath in zip(frames, fpaths):
+        Image.fromarray(frame).save(fpath)
+    return []
+
+
+def ordered_map(executor, func, args, window):
+    """Like executor.map(func, *zip(*args)) with at most window pending calls"""
+    pending = deque()
+    for arg in args:
+        pending.append(executor.submit(func, *arg))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def render(args, out=None):
+    """Writes the frames to the output folder, or to the binary file out"""
+    mosaic_factory = create_mosaic_factory(args)
+    print("loading photos:")
+    mosaic_factory.load(args.folder, args.jobs, print_progress)
+    if args.tour:
+        iterator = tour_iterator(mosaic_factory, args.tiles, args.reuse)
+    else:
+        iterator = image_iterator(mosaic_factory, args.tiles, args.reuse)
+    pictures = list(islice(iterator, args.count + 1))
+    # same thumbnails as the viewer, they are cached once for both
+    size = tile_size(mosaic_factory.ratio, args.tile_pixels)
+    print("creating thumbnails:")
+    mosaic_factory.prepare_thumbnails(
+        *size, args.jobs, lambda *a: print_progress("thumbnails", *a)
+    )
+    frames = max(1, int(round(args.duration * args.fps)))
+    if out is None:
+        makedirs(args.output, exist_ok=True)
+    jobs = []
+    for i, (start_picture, picture) in enumerate(zip(pictures, pictures[1:])):
+        mosaic = mosaic_factory.cached_mosaic(picture, args.tiles, args.reuse)
+        scene_args = (
+            mosaic,
+            start_picture,
+            picture,
+            args.width,
+            args.height,
+            size,
+        )
+        for first in range(0, frames, FRAMES_PER_JOB):
+            numbers = range(first, min(first + FRAMES_PER_JOB, frames))
+            fpaths = None
+            if out is None:
+                fpaths = [
+                    path.join(args.output, "{:06d}.png".format(i * frames + n))
+                    for n in numbers
+                ]
+            jobs.append((i, scene_args, [n / frames for n in numbers], fpaths))
+    total = frames * (len(pictures) - 1)
+    print("rendering {} frames of {}x{} pixels:".format(total, args.width, args.height))
+    done = 0
+    workers = args.jobs or cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        for (_, _, progresses, _), data in zip(
+            jobs, ordered_map(executor, render_frames, jobs, 2 * workers)
+        ):
+            for frame in data:
+                out.write(frame)
+            done += len(progresses)
+            print_progress("frames", done, total)
+    if out is not None:
+        out.flush()
+    mosaic_factory.thumbnails.trim()
+
+
+def main():
+    args = parser.parse_args()
+    if args.output == "-":
+        out = sys.stdout.buffer
+        with redirect_stdout(sys.stderr):
+            render(args, out)
+    else:
+        render(args)
+
+
+if __name__ == "__main__":
+    main()